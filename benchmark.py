@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import zlib
+import hashlib
+import shutil
+import tempfile
+import argparse
+import datetime
+import threading
+import contextlib
+import atexit
+import http.server
+from urllib.parse import urlparse, parse_qs
+
+# Replays a scraper run entirely offline: workshop pages are served from a recorded page cache by a local HTTP server, a fake
+# DepotDownloader writes synthetic map files, and main() is driven end to end. The server also stands in for Steam's
+# GetPublishedFileDetails API. Reports wall time per stage, pages/sec,
+# MB hashed/sec and peak RSS.
+#
+#   python benchmark.py --corpus <PAGE_CACHE_PATH of a previous run> [--maps 200] [--map-size-mb 40] [--output report.json]
+#
+# Without --corpus, synthetic workshop pages and their GetPublishedFileDetails entries are generated instead. A corpus has no API
+# entries, so Steam answers that it doesn't know those ids and every page is fetched.
+
+BROWSE_PAGE_SIZE = 30
+
+FAKE_DEPOT_DOWNLOADER = '''import os, sys, random
+# Stands in for DepotDownloader: writes a synthetic map file and prints its path the way DepotDownloader does
+pubfile, user, password, dirPath = sys.argv[1:5]
+meanSize = int(os.environ["BENCH_MAP_SIZE"])
+rng = random.Random(pubfile)
+size = max(1024, int(rng.gauss(meanSize, meanSize / 3)))
+os.makedirs(dirPath, exist_ok=True)
+path = os.path.join(dirPath, "map" + pubfile + ".udk")
+block = rng.randbytes(1024 * 1024)
+with open(path, "wb") as fp:
+    written = 0
+    while written < size:
+        n = min(len(block), size - written)
+        fp.write(block[:n])
+        written += n
+print("Downloading depot 252950 as " + user)
+print(" 100.00% " + path, flush=True)
+print("Total downloaded: " + str(size) + " bytes")
+'''
+
+DETAILS_PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html><head><title>Steam Workshop::{title}</title></head><body>
+<div id="rightContents">
+<div class="friendBlock"><div class="friendBlockContent">
+	{author}<br>
+	<span class="friendSmallText">Offline</span>
+</div></div>
+<div class="workshopItemTitle">{title}</div>
+<div class="workshopItemDescription" id="highlightContent">{desc}</div>
+<div class="detailsStatsContainerLeft">
+	<div class="detailsStatLeft">File Size </div>
+	<div class="detailsStatLeft">Posted </div>
+	<div class="detailsStatLeft">Updated </div>
+</div>
+<div class="detailsStatsContainerRight">
+	<div class="detailsStatRight">{size} MB</div>
+	<div class="detailsStatRight">{posted}</div>
+	<div class="detailsStatRight">{updated}</div>
+</div>
+</div></body></html>
+'''
+
+
+def loadCorpus(corpusPath, maxMaps):
+    db = sqlite3.connect(os.path.join(corpusPath, "pages.sqlite3"))
+    rows = db.execute("SELECT key, content FROM pages WHERE key LIKE 'workshop/%' ORDER BY key").fetchall()
+    db.close()
+    pages = { key[len("workshop/"):]: zlib.decompress(content) for key, content in rows }
+    ids = sorted(pages)[:maxMaps] if maxMaps else sorted(pages)
+    return { id: pages[id] for id in ids }
+
+# A date the way workshop pages show it, e.g. "Aug 16, 2019 @ 2:51am"
+def steamDate(dt):
+    return f"{dt:%b} {dt.day}, {dt.year} @ {dt.hour % 12 or 12}:{dt.minute:02d}{'am' if dt.hour < 12 else 'pm'}"
+
+# Returns (pages, apiDetails), the workshop pages by id and the GetPublishedFileDetails entry for each of them
+def syntheticCorpus(count):
+    rng = random.Random(252950)
+    pages = {}
+    apiDetails = {}
+    for i in range(count):
+        id = str(2000000000 + i)
+        desc = "<br>".join(" ".join(rng.choice([ "rings", "dribble", "obstacle", "course", "map", "aerial", "training" ]) for _ in range(12)) for _ in range(rng.randint(3, 30)))
+        size = rng.randint(10, 300)
+        # Pages only show minutes, which is what the scraper stores
+        posted = datetime.datetime(2019, 8, 16, 2, 51)
+        updated = datetime.datetime(2021, 1, 1 + i % 28, 15, i % 60)
+        pages[id] = DETAILS_PAGE_TEMPLATE.format(title=f"Map {i}", author=f"Author {i % 50}", desc=desc, size=size,
+            posted=steamDate(posted), updated=steamDate(updated)).encode('utf-8')
+        apiDetails[id] = { "publishedfileid": id, "result": 1, "creator": str(76561198000000000 + i % 50), "creator_app_id": 252950,
+            "consumer_app_id": 252950, "file_size": size * 1024 * 1024, "title": f"Map {i}", "description": desc.replace("<br>", "\n"),
+            "time_created": int(posted.timestamp()), "time_updated": int(updated.timestamp()), "visibility": 0, "banned": 0, "tags": [] }
+    return pages, apiDetails
+
+def browsePage(ids, page):
+    pageIds = ids[(page - 1) * BROWSE_PAGE_SIZE : page * BROWSE_PAGE_SIZE]
+    items = "".join(f'<div class="workshopItem"><a href="https://steamcommunity.com/sharedfiles/filedetails/?id={id}&searchtext=">{id}</a></div>' for id in pageIds)
+    pager = ""
+    if page * BROWSE_PAGE_SIZE < len(ids):
+        pager = f'<a class="pagebtn" href="https://steamcommunity.com/workshop/browse/?appid=252950&browsesort=mostrecent&section=items&actualsort=mostrecent&p={page + 1}">&gt;</a>'
+    return f'<html><body><div id="rightContents"><div class="workshopBrowseItems">{items}</div><div class="workshopBrowsePagingControls">{pager}</div></div></body></html>'.encode('utf-8')
+
+# Serves the browse and details pages for pages, and answers GetPublishedFileDetails from apiDetails. Steam returns "result": 9 for
+# ids it doesn't know.
+def startServer(pages, apiDetails={}):
+    ids = sorted(pages)
+    stats = { "requests": 0, "notModified": 0, "bytes": 0, "apiRequests": 0 }
+    lock = threading.Lock()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            body = None
+            if url.path.startswith("/workshop/browse"):
+                body = browsePage(ids, int(query.get("p", [ "1" ])[0]))
+            elif url.path.startswith("/sharedfiles/filedetails"):
+                body = pages.get(query.get("id", [ "" ])[0])
+            if body is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            # Like Steam, pages carry an ETag and a matching If-None-Match gets a 304 with no body
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            notModified = self.headers.get("If-None-Match") == etag
+            with lock:
+                stats["requests"] += 1
+                if notModified:
+                    stats["notModified"] += 1
+                else:
+                    stats["bytes"] += len(body)
+            if notModified:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode('utf-8'))
+            if not urlparse(self.path).path.startswith("/ISteamRemoteStorage/GetPublishedFileDetails"):
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            requested = [ form[f"publishedfileids[{i}]"][0] for i in range(int(form["itemcount"][0])) ]
+            files = [ apiDetails.get(id, { "publishedfileid": id, "result": 9 }) for id in requested ]
+            body = json.dumps({ "response": { "result": 1, "resultcount": len(files), "publishedfiledetails": files } }).encode('utf-8')
+            with lock:
+                stats["apiRequests"] += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+class StageTimer:
+    # Wraps functions so every call is timed under a stage name. Stages can run on several threads at once, so both the
+    # summed call time and the wall time from the first call starting to the last one finishing are kept.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, stage, start, end):
+        with self.lock:
+            s = self.stages.setdefault(stage, { "calls": 0, "busySeconds": 0, "firstStart": start, "lastEnd": end })
+            s["calls"] += 1
+            s["busySeconds"] += end - start
+            s["firstStart"] = min(s["firstStart"], start)
+            s["lastEnd"] = max(s["lastEnd"], end)
+
+    def wrap(self, owner, name, stage):
+        fn = getattr(owner, name)
+        timer = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timer.record(stage, start, time.perf_counter())
+        if isinstance(owner, type) and isinstance(owner.__dict__.get(name), staticmethod):
+            timed = staticmethod(timed)
+        setattr(owner, name, timed)
+
+    # Like wrap, for a generator function. Each call is timed from when it's made to when the generator is exhausted.
+    def wrapGenerator(self, owner, name, stage):
+        fn = getattr(owner, name)
+        timer = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return (yield from fn(*args, **kwargs))
+            finally:
+                timer.record(stage, start, time.perf_counter())
+        setattr(owner, name, timed)
+
+    # Wall time from the first of stages starting to the last one finishing, for stages that overlap
+    def span(self, stages):
+        found = [ self.stages[stage] for stage in stages if stage in self.stages ]
+        if len(found) == 0:
+            return 0
+        return max(s["lastEnd"] for s in found) - min(s["firstStart"] for s in found)
+
+    def report(self):
+        return { stage: {
+            "calls": s["calls"],
+            "busySeconds": round(s["busySeconds"], 3),
+            "wallSeconds": round(s["lastEnd"] - s["firstStart"], 3)
+        } for stage, s in self.stages.items() }
+
+
+def peakRssMb():
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1))
+
+
+def run(args):
+    pages, apiDetails = (loadCorpus(args.corpus, args.maps), {}) if args.corpus else syntheticCorpus(args.maps or 200)
+    workDir = args.workdir or tempfile.mkdtemp(prefix="rlws-bench-")
+    server, serverStats = startServer(pages, apiDetails)
+
+    fakeDepotDownloader = os.path.join(workDir, "fake_depotdownloader.py")
+    os.makedirs(workDir, exist_ok=True)
+    with open(fakeDepotDownloader, 'w') as fp:
+        fp.write(FAKE_DEPOT_DOWNLOADER)
+
+    # scraper reads its settings at import time, and load_dotenv() doesn't override what's already set here
+    os.environ.update({
+        "BUILD_JSON_PATH": os.path.join(workDir, "build", "maps.json"),
+        "RELEASE_JSON_PATH": os.path.join(workDir, "releases", "maps.json"),
+        "RELEASE_META_JSON_PATH": os.path.join(workDir, "releases", "meta.json"),
+        "HASH_CACHE_PATH": os.path.join(workDir, "build", "hashcache.json"),
+        "WORKSHOP_PATH": os.path.join(workDir, "workshop"),
+        "STEAM_WORKSHOP_PATH": os.path.join(workDir, "steam-workshop"),
+        "PAGE_CACHE_PATH": os.path.join(workDir, "cache"),
+        "STEAM_ACCOUNTS": json.dumps([ [ f"bench{i}", "password" ] for i in range(args.accounts) ]),
+        "STEAM_COMMUNITY_URL": f"http://127.0.0.1:{server.server_address[1]}",
+        "STEAM_API_URL": f"http://127.0.0.1:{server.server_address[1]}",
+        "DEPOT_DOWNLOADER": "DepotDownloader.dll",
+        "DEPOT_DOWNLOADER_COMMAND": f'"{sys.executable}" "{fakeDepotDownloader}" {{}} {{}} {{}} {{}}',
+        "BENCH_MAP_SIZE": str(int(args.map_size_mb * 1024 * 1024)),
+        "CHROME_DRIVER": "none",
+        # The local server never pushes back, so the per-host throttle shouldn't be what's measured
+        "FETCH_RATE": "1000",
+        "FETCH_MAX_RATE": "1000"
+    })
+
+    import scraper
+
+    timer = StageTimer()
+    timer.wrapGenerator(scraper.Scraper, "iterWorkshopIDs", "crawl")
+    timer.wrap(scraper.Scraper, "getWorkshopDetails", "details")
+    timer.wrap(scraper, "extractWorkshopDetails", "parse")
+    timer.wrap(scraper.DepotDownloaderPool, "download", "download")
+    timer.wrap(scraper.HashDetails, "computeFileHashesMany", "hash")
+
+    sys.argv = [ "scraper.py", "skipLeth" ]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w') if args.quiet else sys.stdout):
+        scraper.main(None)
+    total = time.perf_counter() - start
+    server.shutdown()
+    # The scraper's own run report goes into ours instead of the work directory, which may be removed below
+    atexit.unregister(scraper.METRICS.write)
+
+    stages = timer.report()
+    runReport = scraper.METRICS.report()
+    # Only what was actually read, hash cache hits and the blob store's hardlinked copies don't count
+    hashedBytes = runReport["counters"].get("bytesHashed", 0) + runReport["counters"].get("bytesHashedOnExtract", 0)
+    # The crawl and the detail fetches overlap, so the fetch time is the span covering both
+    fetchWall = timer.span([ "crawl", "details" ])
+    hashWall = stages.get("hash", {}).get("wallSeconds", 0)
+    rssSelf, rssChildren = peakRssMb()
+
+    report = {
+        "maps": len(pages),
+        "totalSeconds": round(total, 3),
+        "stages": stages,
+        "pagesServed": serverStats["requests"],
+        "pagesNotModified": serverStats["notModified"],
+        "apiRequests": serverStats["apiRequests"],
+        "pagesPerSecond": round(serverStats["requests"] / fetchWall, 1) if fetchWall > 0 else None,
+        "mbHashed": round(hashedBytes / 1024 / 1024, 1),
+        "mbHashedPerSecond": round(hashedBytes / 1024 / 1024 / hashWall, 1) if hashWall > 0 else None,
+        "peakRssMb": rssSelf,
+        "peakChildRssMb": rssChildren,
+        "runReport": runReport
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=4)
+    print(json.dumps(report, indent=4))
+
+    if not args.workdir and not args.keep:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a scraper run offline and report per-stage timings")
+    parser.add_argument("--corpus", help="PAGE_CACHE_PATH of a previous run to serve workshop pages from")
+    parser.add_argument("--maps", type=int, default=0, help="Only replay this many maps (default: all, or 200 synthetic)")
+    parser.add_argument("--map-size-mb", type=float, default=40, help="Mean size of the synthetic map files")
+    parser.add_argument("--accounts", type=int, default=2, help="Number of fake Steam accounts")
+    parser.add_argument("--workdir", help="Directory for the run's files (default: a temporary directory that is removed afterwards)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory")
+    parser.add_argument("--output", help="Also write the report to this file")
+    parser.add_argument("--quiet", action="store_true", help="Hide the scraper's own output")
+    run(parser.parse_args())
@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import mmap
+import time
+import random
+import struct
+import hashlib
+
+# Compact lookup index from a map file's fullHash or filename to the maps.json ids that contain it, so a map can be identified
+# without parsing the whole maps.json. Covers every mapFileHistory entry of the workshop maps and every Leth map.
+#
+# All integers are little endian. The file is laid out as:
+#   header      magic "RLMI", u16 version, u16 reserved, u32 hashCount, u32 nameCount, u32 idCount
+#   hashes      hashCount records of (16 byte md5 fullHash, u32 id index), sorted
+#   names       nameCount records of (8 byte key, u32 id index), sorted. The key is the first 8 bytes of the blake2b digest
+#               of the lowercased utf-8 filename
+#   ids         idCount records of (u32 offset, u32 length) into the strings section
+#   strings     the utf-8 encoded ids
+#
+# Every record is fixed width so lookups are a binary search straight over the mmap'd file.
+#
+#   python maplookup.py <maps.idx> hash <fullHash>
+#   python maplookup.py <maps.idx> file <filename>
+#   python maplookup.py <maps.idx> bench [maps.json] [lookups]
+
+MAGIC = b"RLMI"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIII")
+HASH_RECORD = struct.Struct("<16sI")
+NAME_RECORD = struct.Struct("<8sI")
+ID_RECORD = struct.Struct("<II")
+
+
+def filenameKey(filename):
+    return hashlib.blake2b(filename.lower().encode('utf-8'), digest_size=8).digest()
+
+# Yields (id, filename, fullHash) for every map file in a release's "maps" dict
+def releaseEntries(maps):
+    for id, m in maps.items():
+        if "mapFileHistory" in m:
+            for mapFile in m["mapFileHistory"]:
+                yield id, mapFile["filename"], mapFile["fullHash"]
+        elif "filename" in m and "fullHash" in m:
+            yield id, m["filename"], m["fullHash"]
+
+def writeIndex(maps, path):
+    ids = list(maps)
+    idIndex = { id: i for i, id in enumerate(ids) }
+    hashes = set()
+    names = set()
+    for id, filename, fullHash in releaseEntries(maps):
+        hashes.add((bytes.fromhex(fullHash), idIndex[id]))
+        names.add((filenameKey(filename), idIndex[id]))
+    hashes = sorted(hashes)
+    names = sorted(names)
+
+    strings = bytearray()
+    idRecords = bytearray()
+    for id in ids:
+        encoded = id.encode('utf-8')
+        idRecords += ID_RECORD.pack(len(strings), len(encoded))
+        strings += encoded
+
+    data = bytearray(HEADER.pack(MAGIC, VERSION, 0, len(hashes), len(names), len(ids)))
+    for record in hashes:
+        data += HASH_RECORD.pack(*record)
+    for record in names:
+        data += NAME_RECORD.pack(*record)
+    data += idRecords
+    data += strings
+
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmpPath, path)
+
+
+class MapIndex:
+
+    def __init__(self, path):
+        self.fp = open(path, 'rb')
+        self.data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.hashCount, self.nameCount, self.idCount = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} map index")
+        self.hashOffset = HEADER.size
+        self.nameOffset = self.hashOffset + self.hashCount * HASH_RECORD.size
+        self.idOffset = self.nameOffset + self.nameCount * NAME_RECORD.size
+        self.stringOffset = self.idOffset + self.idCount * ID_RECORD.size
+
+    def close(self):
+        self.data.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def getId(self, index):
+        offset, length = ID_RECORD.unpack_from(self.data, self.idOffset + index * ID_RECORD.size)
+        start = self.stringOffset + offset
+        return self.data[start : start + length].decode('utf-8')
+
+    # Binary search for the first record whose key is >= key, then collect the ids of every record with that key
+    def search(self, offset, count, record, key):
+        keySize = len(key)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offset + mid * record.size
+            if self.data[start : start + keySize] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        ids = []
+        while lo < count:
+            recordKey, index = record.unpack_from(self.data, offset + lo * record.size)
+            if recordKey != key:
+                break
+            ids.append(self.getId(index))
+            lo += 1
+        return ids
+
+    # Returns the ids of the maps with a file matching fullHash
+    def findByHash(self, fullHash):
+        return self.search(self.hashOffset, self.hashCount, HASH_RECORD, bytes.fromhex(fullHash))
+
+    # Returns the ids of the maps with a file named filename (case insensitive)
+    def findByFilename(self, filename):
+        return self.search(self.nameOffset, self.nameCount, NAME_RECORD, filenameKey(filename))
+
+
+# Times lookups through the index against the parse-maps.json-and-scan approach it replaces
+def benchmark(indexPath, jsonPath=None, lookups=10000):
+    with MapIndex(indexPath) as index:
+        queries = []
+        if jsonPath is not None:
+            with open(jsonPath, 'r') as fp:
+                queries = list(releaseEntries(json.load(fp)["maps"]))
+        if len(queries) == 0:
+            queries = [ (None, "missing.udk", "0" * 32) ]
+        rng = random.Random(0)
+        sample = [ rng.choice(queries) for _ in range(lookups) ]
+
+        start = time.perf_counter()
+        for _, filename, fullHash in sample:
+            index.findByHash(fullHash)
+            index.findByFilename(filename)
+        indexSeconds = time.perf_counter() - start
+        print(f"Index: {lookups} hash + filename lookups in {indexSeconds:.3f}s ({indexSeconds / lookups * 1e6:.1f}us each)")
+
+        if jsonPath is not None:
+            scans = max(1, lookups // 100)
+            start = time.perf_counter()
+            for _, filename, fullHash in sample[:scans]:
+                with open(jsonPath, 'r') as fp:
+                    maps = json.load(fp)["maps"]
+                [ id for id, name, h in releaseEntries(maps) if h == fullHash or name.lower() == filename.lower() ]
+            jsonSeconds = time.perf_counter() - start
+            print(f"maps.json: {scans} parse + scan lookups in {jsonSeconds:.3f}s ({jsonSeconds / scans * 1e6:.1f}us each)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: maplookup.py <maps.idx> hash <fullHash> | file <filename> | bench [maps.json] [lookups]")
+        sys.exit(1)
+    indexPath, command = sys.argv[1], sys.argv[2]
+    if command == "bench":
+        benchmark(indexPath, sys.argv[3] if len(sys.argv) > 3 else None, int(sys.argv[4]) if len(sys.argv) > 4 else 10000)
+    else:
+        with MapIndex(indexPath) as index:
+            ids = index.findByHash(sys.argv[3]) if command == "hash" else index.findByFilename(sys.argv[3])
+            print("\n".join(ids) if len(ids) > 0 else "No match")
@@ -2,31 +2,58 @@ import os
 import sys
 import re
 from bs4 import BeautifulSoup
-import jsonpickle
 import shutil
 import hashlib
 import datetime
 import json
-from random import randint
 from dotenv import load_dotenv
 import subprocess
 import shlex
 import io
 import time
+import threading
+import queue
+import atexit
+import cProfile
+import pstats
+import contextlib
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
 from lxml import etree
 import zipfile
-from google_drive_downloader import GoogleDriveDownloader as gdd
+import zlib
+import gzip
+import sqlite3
+import random
+import heapq
+import itertools
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import platform
+import maplookup
+try:
+    import brotli
+except ImportError:
+    brotli = None # Optional, .br copies of the release files are only written when it's installed
+try:
+    import orjson
+except ImportError:
+    orjson = None # Optional, the build json is read and written with the json module when it's not installed
 
 import selenium
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from selenium.common.exceptions import WebDriverException
 
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
+from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
 
 
 IS_WINDOWS = platform.system() == "Windows"
@@ -39,19 +66,77 @@ RELEASE_JSON_PATH = os.getenv("RELEASE_JSON_PATH")
 RELEASE_META_JSON_PATH = os.getenv("RELEASE_META_JSON_PATH")
 WORKSHOP_PATH = os.getenv("WORKSHOP_PATH")
 STEAM_WORKSHOP_PATH = os.getenv("STEAM_WORKSHOP_PATH") # Something like: C:\Program Files (x86)\Steam\steamapps\workshop\content\252950
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH") or os.path.join(WORKSHOP_PATH or "", ".blobs") # Map files by fullHash, must be on the same filesystem as WORKSHOP_PATH
 STEAM_ACCOUNTS = json.loads(os.getenv("STEAM_ACCOUNTS")) # Stored as [ ["login name", "password"], ["login name2", "password2"], ... ]
 DEPOT_DOWNLOADER = os.getenv("DEPOT_DOWNLOADER")
 PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH")
+JOURNAL_PATH = os.getenv("JOURNAL_PATH") or BUILD_JSON_PATH + ".journal"
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "50")) # Journal events between snapshots of the build json
+HASH_CACHE_PATH = os.getenv("HASH_CACHE_PATH") or os.path.join(os.path.dirname(BUILD_JSON_PATH), "hashcache.json")
+RUN_REPORT_PATH = os.getenv("RUN_REPORT_PATH") or os.path.join(os.path.dirname(BUILD_JSON_PATH), "run-report.json")
+METRICS_TEXTFILE_PATH = os.getenv("METRICS_TEXTFILE_PATH") # Optional Prometheus textfile collector output, e.g. /var/lib/node_exporter/rlws.prom
+PROFILE_STAGES = set(filter(None, os.getenv("PROFILE_STAGES", "").split(","))) # Stages to run under cProfile, e.g. "parse,hash"
+PROFILE_PATH = os.getenv("PROFILE_PATH") or os.path.join(os.path.dirname(BUILD_JSON_PATH), "profiles")
+RELEASE_DELTAS_PATH = os.getenv("RELEASE_DELTAS_PATH") or os.path.join(os.path.dirname(RELEASE_JSON_PATH), "deltas")
+DELTA_HISTORY_PATH = os.getenv("DELTA_HISTORY_PATH") or os.path.join(os.path.dirname(BUILD_JSON_PATH), "delta-history.json")
+MAX_DELTAS = int(os.getenv("MAX_DELTAS", "30")) # Number of previous releases a delta file is kept for
+RELEASE_INDEX_PATH = os.getenv("RELEASE_INDEX_PATH") or os.path.join(os.path.dirname(RELEASE_JSON_PATH), "maps.idx") # See maplookup.py
+STEAM_COMMUNITY_URL = os.getenv("STEAM_COMMUNITY_URL", "https://steamcommunity.com").rstrip('/') # Override to replay saved pages from a local server
+STEAM_API_URL = os.getenv("STEAM_API_URL", "https://api.steampowered.com").rstrip('/')
+STEAM_API_BATCH_SIZE = int(os.getenv("STEAM_API_BATCH_SIZE", "100")) # Ids per GetPublishedFileDetails request
+STEAM_API_BATCH_WAIT = float(os.getenv("STEAM_API_BATCH_WAIT", "0.5")) # Seconds the crawl can go without finding an id before a partial batch is sent
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "8"))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "10"))
+DETAILS_CONCURRENCY = int(os.getenv("DETAILS_CONCURRENCY", "8")) # Number of workshop detail pages fetched at once
+PER_HOST_CONCURRENCY = int(os.getenv("PER_HOST_CONCURRENCY", "4")) # Cap on simultaneous requests to any one host
+FETCH_RATE = float(os.getenv("FETCH_RATE", "5")) # Requests per second each host starts at, adjusted as responses come in
+FETCH_MIN_RATE = 0.2
+FETCH_MAX_RATE = float(os.getenv("FETCH_MAX_RATE", "40"))
+FETCH_RATE_STEP = 1 # Requests per second added to a host's rate for each second's worth of successful requests
+FETCH_RATE_DECREASE = 0.5 # A host's rate is multiplied by this on a 429, a 5xx or a timeout
+FETCH_ATTEMPTS = int(os.getenv("FETCH_ATTEMPTS", "4")) # Tries per page before it's given up on
+FETCH_BACKOFF_BASE = 1 # Seconds, doubled for each attempt and jittered
+FETCH_BACKOFF_MAX = 60
+FETCH_ERROR_BUDGET = int(os.getenv("FETCH_ERROR_BUDGET", "100")) # Retries allowed per run (per poll in watch mode) before failures are given up on straight away
+RATE_LIMIT_COOLDOWN = int(os.getenv("RATE_LIMIT_COOLDOWN", "900")) # Seconds a rate limited Steam account sits out before downloading again
+MAX_DOWNLOAD_ATTEMPTS = int(os.getenv("MAX_DOWNLOAD_ATTEMPTS", "5"))
 
 HASH_ALG = "md5"
+FAST_HASH_ALG = "blake2b" # Stored next to the md5 fullHash, which the plugin still relies on
+FAST_HASH_DIGEST_SIZE = 16
+HASH_CHUNK_SIZE = 1024 * 1024
+SEGMENT_BLOCK_SIZE = 256 # Segment offsets and lengths are multiples of this
+SEGMENT_MIN_LENGTH = 1024
+SEGMENT_MAX_LENGTH = 4096
+SEGMENT_FIRST_READ = 1024 * 1024 # Bytes of each file searched for a segment first, growing 8x each time nothing is found
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "0")) or os.cpu_count() # Threads used to hash downloads as they finish
 MAPS_TO_SKIP = set([ "1567601517", "817001158", "834478221", "2070733495", "941618511", "2395273453" ])
-MOST_RECENT_URL = "https://steamcommunity.com/workshop/browse/?appid=252950&browsesort=mostrecent&section=items&actualsort=mostrecent&p=1"
-FILEDETAILS_URL = "https://steamcommunity.com/sharedfiles/filedetails/?id={}"
-WORKSHOP_URL = "https://steamcommunity.com/sharedfiles/filedetails/?id="
-LETHS_MAPS_START_URL = "https://lethamyr.com/mymaps"
-MAX_CACHE_AGE = 86400 # One day
-
-DepotDownloaderCommand = "dotnet " + DEPOT_DOWNLOADER + " -app 252950 -pubfile {} -user {} -password {} -dir {}"
+MOST_RECENT_URL = STEAM_COMMUNITY_URL + "/workshop/browse/?appid=252950&browsesort=mostrecent&section=items&actualsort=mostrecent&p=1"
+LAST_UPDATED_URL = STEAM_COMMUNITY_URL + "/workshop/browse/?appid=252950&browsesort=lastupdated&section=items&actualsort=lastupdated&p=1"
+WATCH_INTERVAL = int(os.getenv("WATCH_INTERVAL", "300")) # Seconds between polls in watch mode
+FULL_SWEEP_INTERVAL = int(os.getenv("FULL_SWEEP_INTERVAL", str(7 * 86400))) # Seconds between crawls of every browse page, other runs stop at the first page of known maps
+FILEDETAILS_URL = STEAM_COMMUNITY_URL + "/sharedfiles/filedetails/?id={}"
+WORKSHOP_URL = STEAM_COMMUNITY_URL + "/sharedfiles/filedetails/?id="
+PUBLISHED_FILE_DETAILS_URL = STEAM_API_URL + "/ISteamRemoteStorage/GetPublishedFileDetails/v1/"
+LETHAMYR_URL = os.getenv("LETHAMYR_URL", "https://lethamyr.com").rstrip("/")
+LETHS_MAPS_START_URL = LETHAMYR_URL + "/mymaps"
+LETHS_SITEMAP_URL = LETHAMYR_URL + "/sitemap.xml"
+GOOGLE_DRIVE_DOWNLOAD_URL = os.getenv("GOOGLE_DRIVE_URL", "https://drive.google.com").rstrip("/") + "/uc"
+LETH_DOWNLOAD_CONCURRENCY = int(os.getenv("LETH_DOWNLOAD_CONCURRENCY", "4"))
+LETH_DOWNLOAD_ATTEMPTS = 3 # Each retry resumes from what's already on disk
+DRIVER_POOL_SIZE = int(os.getenv("DRIVER_POOL_SIZE", "2")) # Headless browsers kept running when pages are fetched with Selenium
+DRIVER_MAX_PAGES = int(os.getenv("DRIVER_MAX_PAGES", "100")) # Pages a browser loads before it's restarted, browsers leak memory over time
+BLOCKED_ASSETS = [ "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico", "*.css", "*.woff", "*.woff2", "*.ttf", "*.otf" ]
+BROWSER_WAIT_TIMEOUT = 10 # Seconds Selenium waits for the element a page is read for to show up
+PARSER_VERSION = 1 # Bump when extractWorkshopDetails or parseLethMapDetails change what they return, so details parsed by older versions aren't reused
+MAX_CACHE_AGE = 86400 # One day. Each cached page lives for this long, give or take PAGE_CACHE_TTL_JITTER so they don't all expire at once
+PAGE_CACHE_TTL_JITTER = 0.25
+PAGE_CACHE_MAX_AGE = int(os.getenv("PAGE_CACHE_MAX_AGE", str(30 * 86400))) # Pages older than this are evicted from the cache entirely
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))) # Least recently used pages are evicted past this size
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/95.0.4638.69 Safari/537.36"
+
+# DEPOT_DOWNLOADER_COMMAND can replace the whole command, e.g. with a fake downloader script for testing
+DepotDownloaderCommand = os.getenv("DEPOT_DOWNLOADER_COMMAND") or ("dotnet " + DEPOT_DOWNLOADER + " -app 252950 -pubfile {} -user {} -password {} -dir {}")
 
 # Make sure some paths exist
 if not os.path.exists(os.path.dirname(BUILD_JSON_PATH)): os.makedirs(os.path.dirname(BUILD_JSON_PATH))
@@ -76,68 +161,731 @@ def clean_datetime(ts):
     dt = datetime.datetime.strptime(f"{fields[0]} {fields[1]} {time}", "%b %d %Y %I:%M%p")
     return int(dt.timestamp())
 
+def steam_url(href):
+    # Pager links in saved pages are absolute, so keep them pointed at whichever host we're crawling
+    if href.startswith("https://steamcommunity.com"):
+        return STEAM_COMMUNITY_URL + href[len("https://steamcommunity.com"):]
+    return href
+
+class RunMetrics:
+    # Collects per-stage timings, counters and per-account DepotDownloader stats for a run. At exit they're written as a JSON
+    # run report to RUN_REPORT_PATH, and as a Prometheus textfile to METRICS_TEXTFILE_PATH if that's set.
+    # Stages named in PROFILE_STAGES also run under cProfile, with one merged .prof file per stage written to PROFILE_PATH.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.activeProfiler = threading.local()
+        self.reset()
+
+    # Starts a new run, watch calls this at the start of each poll so every report covers only that poll
+    def reset(self):
+        with self.lock:
+            self.startedAt = time.time()
+            self.stages = {}
+            self.counters = {}
+            self.accounts = {}
+            self.profiles = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiler = None
+        # cProfile only sees the thread it was enabled on, and a profiled stage nested in another is already covered by the outer one
+        if name in PROFILE_STAGES and getattr(self.activeProfiler, "profiler", None) is None:
+            profiler = cProfile.Profile()
+            self.activeProfiler.profiler = profiler
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if profiler is not None:
+                profiler.disable()
+                self.activeProfiler.profiler = None
+            with self.lock:
+                stage = self.stages.setdefault(name, { "calls": 0, "seconds": 0, "firstStart": start, "lastEnd": end })
+                stage["calls"] += 1
+                stage["seconds"] += end - start
+                stage["firstStart"] = min(stage["firstStart"], start)
+                stage["lastEnd"] = max(stage["lastEnd"], end)
+                if profiler is not None:
+                    self.profiles.setdefault(name, []).append(profiler)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def recordDownload(self, account, seconds, status):
+        with self.lock:
+            stats = self.accounts.setdefault(account, { "downloads": 0, "seconds": 0, "statuses": {} })
+            stats["downloads"] += 1
+            stats["seconds"] += seconds
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+
+    def report(self):
+        with self.lock:
+            return {
+                "startedAt": int(self.startedAt),
+                "durationSeconds": round(time.time() - self.startedAt, 3),
+                "stages": { name: {
+                    "calls": stage["calls"],
+                    "seconds": round(stage["seconds"], 3), # Summed over every call, so concurrent stages can exceed their wall time
+                    "wallSeconds": round(stage["lastEnd"] - stage["firstStart"], 3)
+                } for name, stage in self.stages.items() },
+                "counters": dict(self.counters),
+                "accounts": { account: {
+                    "downloads": stats["downloads"],
+                    "seconds": round(stats["seconds"], 3),
+                    "statuses": dict(stats["statuses"])
+                } for account, stats in self.accounts.items() }
+            }
+
+    def prometheus(self, report):
+        lines = [
+            "# TYPE rlws_run_timestamp_seconds gauge",
+            f"rlws_run_timestamp_seconds {report['startedAt']}",
+            "# TYPE rlws_run_duration_seconds gauge",
+            f"rlws_run_duration_seconds {report['durationSeconds']}",
+            "# TYPE rlws_stage_seconds gauge",
+            "# TYPE rlws_stage_wall_seconds gauge",
+            "# TYPE rlws_stage_calls gauge"
+        ]
+        for name, stage in report["stages"].items():
+            lines.append(f'rlws_stage_seconds{{stage="{name}"}} {stage["seconds"]}')
+            lines.append(f'rlws_stage_wall_seconds{{stage="{name}"}} {stage["wallSeconds"]}')
+            lines.append(f'rlws_stage_calls{{stage="{name}"}} {stage["calls"]}')
+        lines.append("# TYPE rlws_count gauge")
+        for name, value in report["counters"].items():
+            lines.append(f'rlws_count{{name="{name}"}} {value}')
+        lines.append("# TYPE rlws_account_downloads gauge")
+        lines.append("# TYPE rlws_account_download_seconds gauge")
+        for account, stats in report["accounts"].items():
+            for status, n in stats["statuses"].items():
+                lines.append(f'rlws_account_downloads{{account="{account}",status="{status}"}} {n}')
+            lines.append(f'rlws_account_download_seconds{{account="{account}"}} {stats["seconds"]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        report = self.report()
+        with open(RUN_REPORT_PATH, 'w') as fp:
+            json.dump(report, fp, indent=4)
+        if METRICS_TEXTFILE_PATH:
+            # Write then rename so the collector never reads a half written file
+            with open(METRICS_TEXTFILE_PATH + ".tmp", 'w') as fp:
+                fp.write(self.prometheus(report))
+            os.replace(METRICS_TEXTFILE_PATH + ".tmp", METRICS_TEXTFILE_PATH)
+        if len(self.profiles) > 0:
+            if not os.path.exists(PROFILE_PATH):
+                os.makedirs(PROFILE_PATH)
+            for name, profilers in self.profiles.items():
+                stats = pstats.Stats(profilers[0])
+                for profiler in profilers[1:]:
+                    stats.add(profiler)
+                stats.dump_stats(os.path.join(PROFILE_PATH, f"{name}.prof"))
+        print(f"Run report written to {RUN_REPORT_PATH}")
+
+METRICS = RunMetrics()
+
+STREAM_IDLE = object()
+
+# Runs the items generator on a background thread and yields what it produces as soon as it's produced, so a slow producer
+# (a crawl waiting on pages) and the consumer overlap. An exception in the producer is raised in the consumer. With idle, yields
+# STREAM_IDLE whenever the producer has gone that many seconds without producing anything.
+def streamInBackground(items, name, idle=None):
+    results = queue.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                results.put((item, None))
+        except BaseException as e:
+            results.put((done, e))
+            return
+        results.put((done, None))
+
+    threading.Thread(target=produce, name=name, daemon=True).start()
+    while True:
+        try:
+            item, error = results.get(timeout=idle)
+        except queue.Empty:
+            yield STREAM_IDLE
+            continue
+        if item is done:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+# Splits items into lists of up to size items, without reading ahead of the batch being filled. With wait, items are read on a
+# background thread and the batch being filled is yielded early once no item has come for wait seconds, so the items a slow
+# producer has already produced aren't held back until it produces the rest.
+def batched(items, size, wait=None):
+    if wait is not None:
+        items = streamInBackground(items, "batchFill", idle=wait)
+    batch = []
+    for item in items:
+        if item is not STREAM_IDLE:
+            batch.append(item)
+        if len(batch) >= size or (item is STREAM_IDLE and len(batch) > 0):
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+# Like map(), but runs fn on up to `concurrency` items at a time and yields results in the order of items
+def boundedMap(fn, items, concurrency):
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
 def mapFilePath(map, mapFile):
-    fp = os.path.join(WORKSHOP_PATH, map.workshopId, mapFile["filename"])
+    fp = os.path.join(WORKSHOP_PATH, map.workshopId, mapFile.filename)
     if os.path.exists(fp):
         return fp
-    fp = os.path.join(WORKSHOP_PATH, map.workshopId, mapFile["filename"])
+    fp = os.path.join(WORKSHOP_PATH, map.workshopId, mapFile.filename)
     if os.path.exists(fp):
         return fp
     return None
 
 
+# Workshop page extraction. The lxml versions below are the ones used for scraping. The BeautifulSoup versions are the
+# original implementation, kept so compareExtractors can check both give identical output over the page cache.
+
+# html.parser decodes entities that are missing their semicolon inside links too, so the "&sect" in "&section=" turns into "§".
+# Browsers and lxml leave those alone, so the ampersands in links that don't start a complete reference are escaped first.
+def escapeLinkAmpersands(pageSource):
+    return HREF_ATTRIBUTE.sub(lambda m: BARE_AMPERSAND.sub('&amp;', m.group(0)), pageSource)
+
+HREF_ATTRIBUTE = re.compile(r"""href=("[^"]*"|'[^']*')""")
+BARE_AMPERSAND = re.compile(r"&(?!#?\w+;)")
+
+def extractBrowsePageSoup(pageSource):
+    ids = []
+    soup = BeautifulSoup(escapeLinkAmpersands(pageSource), "html.parser")
+    workshopItems = soup.find('div', { 'class': 'workshopBrowseItems' })
+    for a in workshopItems.findAll('a'):
+        link = a['href']
+        if 'filedetails' in link:
+            ids.append(link[link.rfind('id=') + 3 : link.rfind('&')])
+    paging = soup.find('div', { 'class': 'workshopBrowsePagingControls' })
+    url = None
+    for btn in paging.findAll('a'):
+        if btn.contents[0] == '>':
+            url = steam_url(btn['href'])
+    return ids, url
+
+def extractWorkshopDetailsSoup(id, pageSource):
+    soup = BeautifulSoup(pageSource, "html.parser")
+
+    author_element = soup.find('div', {'class':'friendBlockContent'})
+    title_element = soup.find('div', {'class':'workshopItemTitle'})
+    description_element = soup.find('div', {'class':'workshopItemDescription', 'id':'highlightContent'})
+    detailsLeft = soup.find('div', { 'class': 'detailsStatsContainerLeft' })
+    detailsRight = soup.find('div', { 'class': 'detailsStatsContainerRight' })
+
+    if author_element is None or title_element is None or description_element is None or detailsLeft is None or detailsRight is None:
+        print(f"FAILED TO GET SOME DATA FOR -> {id}")
+        return None
+
+    
+    author = clean_str(author_element.contents[0])
+    title = clean_str(title_element.contents[0])
+    
+    desc = description_element.get_text('\n')
+    desc = desc.replace("~~", "")
+
+    published = None
+    lastUpdated = None
+    for i, div in enumerate(detailsLeft.findAll('div')):
+        if div.get_text().strip().lower() == "posted":
+            divsRight = detailsRight.findAll("div")
+            if len(divsRight) > i and '@' in divsRight[i].get_text():
+                published = clean_datetime(divsRight[i].get_text())
+        elif div.get_text().strip().lower() == "updated":
+            divsRight = detailsRight.findAll("div")
+            if len(divsRight) > i and '@' in divsRight[i].get_text():
+                lastUpdated = clean_datetime(divsRight[i].get_text())
+
+    if published is None:
+        print(f"FAILED TO GET PUBLISHED FOR -> {id}")
+        return None
+
+    if lastUpdated is None:
+        lastUpdated = published
+
+    return { "title": title, "author": author, "desc": desc, "published": published, "lastUpdated": lastUpdated }
+
+def xpathHasClass(cls):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')"
+
+BROWSE_ITEM_LINKS_XPATH = etree.XPath(f"(//div[{xpathHasClass('workshopBrowseItems')}])[1]//a[@href]")
+BROWSE_PAGER_LINKS_XPATH = etree.XPath(f"(//div[{xpathHasClass('workshopBrowsePagingControls')}])[1]//a")
+AUTHOR_XPATH = etree.XPath(f"//div[{xpathHasClass('friendBlockContent')}]")
+TITLE_XPATH = etree.XPath(f"//div[{xpathHasClass('workshopItemTitle')}]")
+DESCRIPTION_XPATH = etree.XPath(f"//div[{xpathHasClass('workshopItemDescription')} and @id='highlightContent']")
+DETAILS_LEFT_XPATH = etree.XPath(f"//div[{xpathHasClass('detailsStatsContainerLeft')}]")
+DETAILS_RIGHT_XPATH = etree.XPath(f"//div[{xpathHasClass('detailsStatsContainerRight')}]")
+
+HTML_SPACES = ' \n\t\x0c\r'
+
+# BeautifulSoup replaces a string of nothing but whitespace with a single newline, or a space if it has no newline, outside <pre> and <textarea>
+def collapseWhitespace(string, preserve):
+    if preserve or string.strip(HTML_SPACES) != '':
+        return string
+    return '\n' if '\n' in string else ' '
+
+# The strings BeautifulSoup's get_text() would join: text and tails, but not comments or script/style contents
+def elementStrings(el, preserve=False):
+    if isinstance(el.tag, str) and el.tag not in ('script', 'style'):
+        preserve = preserve or el.tag in ('pre', 'textarea')
+        if el.text:
+            yield collapseWhitespace(el.text, preserve)
+        for child in el:
+            yield from elementStrings(child, preserve)
+            if child.tail:
+                yield collapseWhitespace(child.tail, preserve)
+
+def elementText(el, separator=''):
+    return separator.join(elementStrings(el))
+
+# BeautifulSoup's tag.contents[0], when it's a string
+def firstString(el):
+    return collapseWhitespace(el.text, el.tag in ('pre', 'textarea')) if el.text is not None else ''
+
+def parseHtml(pageSource):
+    # libxml2 turns \r\n into \n, which html.parser doesn't, so those pages go through the original parser to keep output identical
+    if '\r' in pageSource:
+        return None
+    return etree.HTML(pageSource)
+
+def extractBrowsePage(pageSource):
+    dom = parseHtml(pageSource)
+    if dom is None:
+        return extractBrowsePageSoup(pageSource)
+    ids = []
+    for a in BROWSE_ITEM_LINKS_XPATH(dom):
+        link = a.get('href')
+        if 'filedetails' in link:
+            ids.append(link[link.rfind('id=') + 3 : link.rfind('&')])
+    url = None
+    for btn in BROWSE_PAGER_LINKS_XPATH(dom):
+        if btn.text == '>' and btn.get('href') is not None:
+            url = steam_url(btn.get('href'))
+    return ids, url
+
+def extractWorkshopDetails(id, pageSource):
+    dom = parseHtml(pageSource)
+    if dom is None:
+        return extractWorkshopDetailsSoup(id, pageSource)
+
+    elements = [ xpath(dom) for xpath in [ AUTHOR_XPATH, TITLE_XPATH, DESCRIPTION_XPATH, DETAILS_LEFT_XPATH, DETAILS_RIGHT_XPATH ] ]
+    if any(len(found) == 0 for found in elements):
+        print(f"FAILED TO GET SOME DATA FOR -> {id}")
+        return None
+    author_element, title_element, description_element, detailsLeft, detailsRight = [ found[0] for found in elements ]
+
+    author = clean_str(firstString(author_element))
+    title = clean_str(firstString(title_element))
+
+    desc = elementText(description_element, '\n')
+    desc = desc.replace("~~", "")
+
+    published = None
+    lastUpdated = None
+    divsRight = [ elementText(div) for div in detailsRight.iterdescendants('div') ]
+    for i, div in enumerate(detailsLeft.iterdescendants('div')):
+        label = elementText(div).strip().lower()
+        if label == "posted":
+            if len(divsRight) > i and '@' in divsRight[i]:
+                published = clean_datetime(divsRight[i])
+        elif label == "updated":
+            if len(divsRight) > i and '@' in divsRight[i]:
+                lastUpdated = clean_datetime(divsRight[i])
+
+    if published is None:
+        print(f"FAILED TO GET PUBLISHED FOR -> {id}")
+        return None
+
+    if lastUpdated is None:
+        lastUpdated = published
+
+    return { "title": title, "author": author, "desc": desc, "published": published, "lastUpdated": lastUpdated }
+
+# Runs the lxml and BeautifulSoup extractors over every cached workshop page and reports any difference in their output
+def compareExtractors():
+    pageCache = PageCache()
+    pages = pageCache.getAllPages("workshop/")
+    mismatches = 0
+    timings = { "lxml": 0, "soup": 0 }
+    for key, pageSource in pages:
+        id = key[key.find('/') + 1:]
+        start = time.perf_counter()
+        fast = extractWorkshopDetails(id, pageSource)
+        timings["lxml"] += time.perf_counter() - start
+        start = time.perf_counter()
+        slow = extractWorkshopDetailsSoup(id, pageSource)
+        timings["soup"] += time.perf_counter() - start
+        if fast != slow:
+            mismatches += 1
+            print(f"EXTRACTOR MISMATCH FOR -> {id}\n\tlxml: {fast}\n\tsoup: {slow}")
+    print(f"Compared {len(pages)} pages, {mismatches} mismatches. lxml: {timings['lxml']:.2f}s, BeautifulSoup: {timings['soup']:.2f}s")
+
+    # Browse pages aren't cached, so the first few are fetched to compare those extractors
+    url = MOST_RECENT_URL
+    for _ in range(3):
+        try:
+            response = requests.get(url, headers={ "User-Agent": USER_AGENT }, timeout=30)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Couldn't fetch {url} to compare the browse page extractors: {e}")
+            return False
+        fast = extractBrowsePage(response.text)
+        slow = extractBrowsePageSoup(response.text)
+        if fast != slow:
+            mismatches += 1
+            print(f"EXTRACTOR MISMATCH FOR -> {url}\n\tlxml: {fast}\n\tsoup: {slow}")
+        url = fast[1]
+        if url is None:
+            break
+    print(f"Compared the browse pages, {mismatches} mismatches in total")
+    return mismatches == 0
+
+
 class PageCache:
+    # All pages live in one SQLite database, zlib compressed, each with its own expiry time and a hash of its content.
+    # The response's ETag/Last-Modified are kept so expired pages can be revalidated. The details parsed from a page are kept in
+    # a second table keyed by its content hash and PARSER_VERSION, so a page that hasn't changed is never parsed twice.
 
     def __init__(self):
         if not os.path.exists(PAGE_CACHE_PATH):
             os.makedirs(PAGE_CACHE_PATH)
-        self.cacheTime = int(datetime.datetime.now().timestamp())
-
-        mostRecentCache = 0
+        self.removeLegacyCacheDirs()
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(PAGE_CACHE_PATH, "pages.sqlite3"), check_same_thread=False)
+        # It's only a cache, so don't pay for an fsync on every page written
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS pages (
+            key TEXT PRIMARY KEY,
+            content BLOB NOT NULL,
+            contentHash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            fetchedAt INTEGER NOT NULL,
+            expiresAt INTEGER NOT NULL,
+            accessedAt INTEGER NOT NULL,
+            etag TEXT,
+            lastModified TEXT
+        )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS parsed (
+            contentHash TEXT NOT NULL,
+            parserVersion INTEGER NOT NULL,
+            details TEXT NOT NULL,
+            PRIMARY KEY (contentHash, parserVersion)
+        )""")
+        self.db.commit()
+        self.evict()
+
+    # Older versions wrote every page into a new PAGE_CACHE_PATH/<timestamp>/ directory each day
+    def removeLegacyCacheDirs(self):
         for cacheDir in os.listdir(PAGE_CACHE_PATH):
-            if os.path.isdir(os.path.join(PAGE_CACHE_PATH, cacheDir)):
-                try:
-                    cacheTime = int(cacheDir)
-                    mostRecentCache = max(cacheTime, mostRecentCache)
-                except ValueError:
-                    pass
-        if self.cacheTime - mostRecentCache <= MAX_CACHE_AGE:
-            self.cacheTime = mostRecentCache
-        else:
-            os.makedirs(os.path.join(PAGE_CACHE_PATH, str(self.cacheTime)))
+            if cacheDir.isdigit() and os.path.isdir(os.path.join(PAGE_CACHE_PATH, cacheDir)):
+                print(f"Removing old page cache directory {cacheDir}")
+                shutil.rmtree(os.path.join(PAGE_CACHE_PATH, cacheDir), ignore_errors=True)
+
+    def evict(self):
+        now = int(time.time())
+        with self.lock:
+            changes = self.db.total_changes
+            self.db.execute("DELETE FROM pages WHERE fetchedAt < ?", (now - PAGE_CACHE_MAX_AGE,))
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            if total > PAGE_CACHE_MAX_BYTES:
+                for key, size in self.db.execute("SELECT key, size FROM pages ORDER BY accessedAt").fetchall():
+                    self.db.execute("DELETE FROM pages WHERE key = ?", (key,))
+                    total -= size
+                    if total <= PAGE_CACHE_MAX_BYTES:
+                        break
+            self.db.execute("DELETE FROM parsed WHERE parserVersion != ? OR contentHash NOT IN (SELECT contentHash FROM pages)", (PARSER_VERSION,))
+            self.db.commit()
+            if self.db.total_changes != changes:
+                self.db.execute("VACUUM")
 
-    def getWorkshopMapPage(self, workshopId):
-        fpath = os.path.join(PAGE_CACHE_PATH, str(self.cacheTime), workshopId)
-        if os.path.exists(fpath):
-            with open(fpath, 'r', encoding='utf-8') as fp:
-                return fp.read()
+    @staticmethod
+    def workshopKey(workshopId):
+        return "workshop/" + workshopId
 
-    def setWorkshopMapPage(self, workshopId, data):
-        fpath = os.path.join(PAGE_CACHE_PATH, str(self.cacheTime), workshopId)
-        with open(fpath, 'wb') as fp:
-            fp.write(data.encode('utf-8'))
+    @staticmethod
+    def lethKey(link):
+        return "leth/" + link[link.rfind('/') + 1: ]
+
+    def expiry(self, now):
+        return now + int(MAX_CACHE_AGE * random.uniform(1 - PAGE_CACHE_TTL_JITTER, 1 + PAGE_CACHE_TTL_JITTER))
 
-    def getLethMapPage(self, link):
-        fpath = os.path.join(PAGE_CACHE_PATH, str(self.cacheTime), link[link.rfind('/') + 1: ])
-        if os.path.exists(fpath):
-            with open(fpath, 'r', encoding='utf-8') as fp:
-                return fp.read()
+    def getPage(self, key):
+        entry = self.lookup(key)
+        if entry is None or not entry["fresh"]:
+            return None
+        return entry["content"]
+
+    # Returns the cached entry for key even if it has expired, or None if there isn't one
+    def lookup(self, key):
+        now = int(time.time())
+        with self.lock:
+            row = self.db.execute("""SELECT content, expiresAt, etag, lastModified, details FROM pages
+                LEFT JOIN parsed ON parsed.contentHash = pages.contentHash AND parserVersion = ? WHERE key = ?""", (PARSER_VERSION, key)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE pages SET accessedAt = ? WHERE key = ?", (now, key))
+            self.db.commit()
+        content, expiresAt, etag, lastModified, parsed = row
+        return {
+            "content": zlib.decompress(content).decode('utf-8'),
+            "fresh": expiresAt > now,
+            "etag": etag,
+            "lastModified": lastModified,
+            "parsed": None if parsed is None else json.loads(parsed)
+        }
+
+    # Stores data under key and returns True if it differs from what was cached before
+    def setPage(self, key, data, etag=None, lastModified=None):
+        now = int(time.time())
+        raw = data.encode('utf-8')
+        contentHash = hashlib.sha256(raw).hexdigest()
+        content = zlib.compress(raw)
+        with self.lock:
+            row = self.db.execute("SELECT contentHash FROM pages WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO pages (key, content, contentHash, size, fetchedAt, expiresAt, accessedAt, etag, lastModified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, content, contentHash, len(content), now, self.expiry(now), now, etag, lastModified))
+            self.db.commit()
+        return row is None or row[0] != contentHash
+
+    # Returns [ (key, pageSource) ] for every cached page whose key starts with prefix, expired or not
+    def getAllPages(self, prefix):
+        with self.lock:
+            rows = self.db.execute("SELECT key, content FROM pages WHERE key LIKE ? ORDER BY key", (prefix + '%',)).fetchall()
+        return [ (key, zlib.decompress(content).decode('utf-8')) for key, content in rows ]
+
+    # The server said the page hasn't changed, so it's good for another TTL
+    def refresh(self, key):
+        now = int(time.time())
+        with self.lock:
+            self.db.execute("UPDATE pages SET fetchedAt = ?, expiresAt = ? WHERE key = ?", (now, self.expiry(now), key))
+            self.db.commit()
+
+    # Returns the details parsed from the page cached under key by this PARSER_VERSION, or None if it hasn't been parsed
+    def getParsed(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT details FROM pages JOIN parsed ON parsed.contentHash = pages.contentHash AND parserVersion = ? WHERE key = ?",
+                (PARSER_VERSION, key)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # Remembers the details parsed from the page cached under key, for any page with the same content
+    def setParsed(self, key, details):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO parsed (contentHash, parserVersion, details) SELECT contentHash, ?, ? FROM pages WHERE key = ?",
+                (PARSER_VERSION, json.dumps(details), key))
+            self.db.commit()
+
+
+class DepotDownloaderPool:
+    # Runs one DepotDownloader worker per Steam account. Queued pubfiles go to whichever account is free.
+    # Rate limited accounts requeue their pubfile and sit out RATE_LIMIT_COOLDOWN seconds instead of being dropped.
+
+    OK = "ok"
+    RATE_LIMITED = "rateLimited"
+    NOT_FOUND = "notFound"
+    FAILED = "failed"
+
+    def __init__(self, accounts, identifyMapFromFiles):
+        self.identifyMapFromFiles = identifyMapFromFiles
+        self.queue = queue.Queue()
+        self.stopping = threading.Event() # Cuts rate limit cooldowns short on shutdown
+        self.workers = []
+        for steamUser, steamPass in accounts:
+            worker = threading.Thread(target=self.work, args=(steamUser, steamPass), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    # Returns a Future that resolves to the downloaded map file, or None if it couldn't be downloaded
+    def submit(self, workshopId):
+        future = Future()
+        if len(self.workers) == 0:
+            print(f"No steam accounts to download {workshopId} with")
+            future.set_result(None)
+        else:
+            self.queue.put((workshopId, future, 1))
+        return future
+
+    # Stops the workers once they've finished what's queued
+    def shutdown(self):
+        self.stopping.set()
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def work(self, steamUser, steamPass):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            workshopId, future, attempt = job
+            # Whatever goes wrong, the future has to be resolved and the worker has to keep going, or the run waits on it forever
+            try:
+                self.runJob(workshopId, future, attempt, steamUser, steamPass)
+            except Exception as e:
+                print(f"FAILED TO GET MAP FILE FOR -> {workshopId}. Error: {e}")
+                if not future.done():
+                    future.set_result(None)
+
+    def runJob(self, workshopId, future, attempt, steamUser, steamPass):
+        start = time.perf_counter()
+        try:
+            with METRICS.stage("download"):
+                status, mapFiles = self.download(workshopId, steamUser, steamPass)
+        except Exception as e:
+            print(f"FAILED TO RUN DEPOTDOWNLOADER FOR -> {workshopId}. Error: {e}")
+            status, mapFiles = DepotDownloaderPool.FAILED, []
+        METRICS.recordDownload(steamUser, time.perf_counter() - start, status)
+
+        if status == DepotDownloaderPool.RATE_LIMITED:
+            if attempt < MAX_DOWNLOAD_ATTEMPTS:
+                self.queue.put((workshopId, future, attempt + 1))
+            else:
+                print(f"GIVING UP ON DOWNLOAD FOR -> {workshopId} after {attempt} rate limited attempts")
+                future.set_result(None)
+            print(f"Steam account {steamUser} was rate limited, cooling down for {RATE_LIMIT_COOLDOWN} seconds")
+            sys.stdout.flush()
+            self.stopping.wait(RATE_LIMIT_COOLDOWN)
+        elif status == DepotDownloaderPool.OK:
+            future.set_result(self.identifyMapFromFiles(mapFiles))
+        else:
+            future.set_result(None)
 
-    def setLethMapPage(self, link, data):
-        fpath = os.path.join(PAGE_CACHE_PATH, str(self.cacheTime), link[link.rfind('/') + 1: ])
-        with open(fpath, 'wb') as fp:
-            fp.write(data.encode('utf-8'))
+    def download(self, workshopId, steamUser, steamPass):
+        print(f"Downloading workshop files for: {workshopId} (account {steamUser})")
+        sys.stdout.flush()
+        dirPath = os.path.join(WORKSHOP_PATH, workshopId)
+        cmd = DepotDownloaderCommand.format(workshopId, steamUser, steamPass, dirPath)
+        BlobStore.breakLinks(dirPath)
 
+        process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE)
+        mapFiles = []
+        lines = []
+        rateLimited = False
 
-class Scraper:
+        unescapedWorkshopPath = WORKSHOP_PATH.replace('\\\\', '\\')
+        while True:
+            line = process.stdout.readline()
+            if not line or (line == '' and process.poll() is not None):
+                break
+            if line:
+                line = line.decode('iso-8859-1').strip()
+                lines.append(line)
+                if (".udk" in line or ".upk" in line or ".umap" in line) and unescapedWorkshopPath in line:
+                    mapFiles.append(line[line.find(unescapedWorkshopPath):].replace('\n',''))
+                elif "RateLimitedExceeded" in line:
+                    rateLimited = True
+                elif "Encountered error" in line and "NotFound" in line:
+                    process.kill()
+                    process.wait()
+                    print(f"ABORTING DOWNLOAD FOR -> {workshopId}. Error: {line}")
+                    return DepotDownloaderPool.NOT_FOUND, []
+        process.wait()
+        if len(mapFiles) == 0:
+            if rateLimited:
+                return DepotDownloaderPool.RATE_LIMITED, []
+            print(f"FAILED TO GET MAP FILE FOR -> {workshopId}. Command: {cmd}")
+            print('\n'.join(lines).encode('utf-8', errors='ignore'))
+            return DepotDownloaderPool.FAILED, []
+        return DepotDownloaderPool.OK, mapFiles
+
+
+class DriverPool:
+    # Headless browsers shared between threads. Each one loads a single page at a time, so pages are fetched by checking a driver
+    # out. Browsers are started lazily, up to size of them, and restarted after maxPages pages.
+
+    def __init__(self, size, maxPages):
+        self.maxPages = maxPages
+        self.idle = queue.Queue()
+        for _ in range(max(1, size)):
+            self.idle.put(None) # A free slot that starts a new browser when it's checked out
+        self.pagesLoaded = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def checkout(self):
+        driver = self.idle.get()
+        if driver is None:
+            try:
+                driver = DriverPool.createDriver()
+            except Exception:
+                self.idle.put(None)
+                raise
+            with self.lock:
+                self.pagesLoaded[driver] = 0
+        broken = True
+        try:
+            yield driver
+            broken = False
+        finally:
+            self.checkin(driver, broken)
+
+    def checkin(self, driver, broken):
+        with self.lock:
+            self.pagesLoaded[driver] += 1
+            recycle = broken or self.pagesLoaded[driver] >= self.maxPages
+            if recycle:
+                del self.pagesLoaded[driver]
+        if not recycle:
+            self.idle.put(driver)
+            return
+        METRICS.count("driverRecycled")
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f"Failed to quit selenium driver: {e}")
+        self.idle.put(None)
+
+    def shutdown(self):
+        with self.lock:
+            drivers = list(self.pagesLoaded)
+            self.pagesLoaded = {}
+        if len(drivers) > 0:
+            print(f"Killing {len(drivers)} selenium drivers")
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
 
-    def __init__(self, pageCache):     
+    # Browsers don't load images, stylesheets or fonts, and pages count as loaded once the DOM is ready (the "eager" strategy)
+    @staticmethod
+    def createDriver():
         if 'chrome' in CHROME_DRIVER:
             chrome_options = selenium.webdriver.ChromeOptions()
             chrome_options.add_argument('--no-sandbox')
             chrome_options.add_argument('--headless')
             chrome_options.add_argument('--disable-gpu')
-            self.driver = selenium.webdriver.Chrome(chrome_options=chrome_options)
+            chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+            chrome_options.add_experimental_option("prefs", {
+                "profile.managed_default_content_settings.images": 2,
+                "profile.managed_default_content_settings.stylesheets": 2,
+                "profile.managed_default_content_settings.fonts": 2
+            })
+            capabilities = DesiredCapabilities.CHROME.copy()
+            capabilities["pageLoadStrategy"] = "eager"
+            driver = selenium.webdriver.Chrome(chrome_options=chrome_options, desired_capabilities=capabilities)
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", { "urls": BLOCKED_ASSETS })
+            return driver
         elif 'gecko' in CHROME_DRIVER:
             #options = FirefoxOptions()
             #options.add_argument("--headless")
@@ -146,103 +894,387 @@ class Scraper:
             #    options=options)
             options = FirefoxOptions()
             options.add_argument('--headless')
-            self.driver = selenium.webdriver.Firefox(firefox_binary=FirefoxBinary('/workshop-maps/geckodriver'), firefox_options=options)
+            profile = FirefoxProfile()
+            profile.set_preference("permissions.default.image", 2)
+            profile.set_preference("permissions.default.stylesheet", 2)
+            profile.set_preference("browser.display.use_document_fonts", 0)
+            profile.set_preference("gfx.downloadable_fonts.enabled", False)
+            capabilities = DesiredCapabilities.FIREFOX.copy()
+            capabilities["pageLoadStrategy"] = "eager"
+            return selenium.webdriver.Firefox(firefox_profile=profile, firefox_binary=FirefoxBinary('/workshop-maps/geckodriver'), firefox_options=options, capabilities=capabilities)
+
+
+class FetchFailed(Exception):
+    # A fetch that failed in a way worth trying again later: a timeout, a dropped connection, a 429 or a 5xx
+    pass
+
+
+class HostThrottle:
+    # Paces the requests to one host with a token bucket. Its rate adapts AIMD style: each success adds a little, each 429, 5xx or
+    # timeout cuts it by FETCH_RATE_DECREASE. It also holds the host's PER_HOST_CONCURRENCY slots, use it as a context manager.
+
+    def __init__(self, host):
+        self.host = host
+        self.rate = FETCH_RATE
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+        self.lastDecrease = 0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(PER_HOST_CONCURRENCY)
+
+    def __enter__(self):
+        self.slots.acquire()
+        self.take()
+        return self
+
+    def __exit__(self, *args):
+        self.slots.release()
+
+    # Blocks until the bucket has a token for another request
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(PER_HOST_CONCURRENCY, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.pausedUntil and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.pausedUntil - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(FETCH_MAX_RATE, self.rate + FETCH_RATE_STEP / self.rate)
+
+    # Cuts the rate, at most once a second so the requests that were already in flight when the host pushed back only count once.
+    # With retryAfter, nothing is sent to the host for that many seconds.
+    def backOff(self, retryAfter=None):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.lastDecrease >= 1:
+                self.rate = max(FETCH_MIN_RATE, self.rate * FETCH_RATE_DECREASE)
+                self.lastDecrease = now
+                print(f"Slowing down requests to {self.host} to {self.rate:.2f} per second")
+            if retryAfter is not None:
+                self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+        METRICS.count("fetchBackOff")
+
+
+class FetchScheduler:
+    # Every outbound request goes through here, paced by its host's HostThrottle. Failures worth retrying raise FetchFailed and are
+    # retried after a jittered exponential backoff, either in place (retry) or from the back of the queue (map). Retries come out
+    # of an error budget. Once it's spent, failures are given up on straight away, so an outage can't turn a run into hours of backing off.
+
+    def __init__(self, session):
+        self.session = session
+        self.throttles = {}
+        self.lock = threading.Lock()
+        self.resetErrorBudget()
+
+    def resetErrorBudget(self):
+        with self.lock:
+            self.errorBudget = FETCH_ERROR_BUDGET
+
+    def throttle(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.throttles:
+                self.throttles[host] = HostThrottle(host)
+            return self.throttles[host]
+
+    # Sends one request and returns the response, unless it timed out, the connection failed or the server answered 429 or 5xx,
+    # which raise FetchFailed
+    def request(self, method, url, **kwargs):
+        throttle = self.throttle(url)
+        with throttle:
+            try:
+                response = self.session.request(method, url, timeout=HTTP_TIMEOUT, **kwargs)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                throttle.backOff()
+                raise FetchFailed(f"{url}: {e}") from e
+        if response.status_code == 429 or response.status_code >= 500:
+            retryAfter = response.headers.get("Retry-After", "")
+            response.close()
+            throttle.backOff(int(retryAfter) if retryAfter.isdigit() else None)
+            raise FetchFailed(f"{url}: HTTP {response.status_code}")
+        throttle.succeeded()
+        return response
+
+    # Seconds to wait before trying again after `attempt` tries. Fully jittered, so retries from many threads spread out.
+    def backoff(self, attempt):
+        return random.uniform(0, min(FETCH_BACKOFF_MAX, FETCH_BACKOFF_BASE * 2 ** attempt))
+
+    # Takes a retry out of the error budget, or returns False if it's spent
+    def spendErrorBudget(self):
+        with self.lock:
+            if self.errorBudget <= 0:
+                return False
+            self.errorBudget -= 1
+            spent = self.errorBudget == 0
+        METRICS.count("fetchRetry")
+        if spent:
+            print(f"Used up the error budget of {FETCH_ERROR_BUDGET} retries, failed fetches won't be retried again")
+        return True
+
+    def giveUp(self, attempt, error):
+        METRICS.count("fetchError")
+        return attempt >= FETCH_ATTEMPTS or not self.spendErrorBudget()
+
+    # Calls fetch until it doesn't raise FetchFailed, up to FETCH_ATTEMPTS times. Returns what it returned, or None if every attempt failed.
+    def retry(self, fetch, description):
+        attempt = 1
+        while True:
+            try:
+                return fetch()
+            except FetchFailed as e:
+                if self.giveUp(attempt, e):
+                    print(f"Giving up on {description} after {attempt} attempts: {e}")
+                    return None
+                delay = self.backoff(attempt)
+                print(f"Request failed ({e}), retrying in {delay:.1f} seconds")
+                sys.stdout.flush()
+                time.sleep(delay)
+                attempt += 1
+
+    # Like boundedMap, but an item whose fn raises FetchFailed goes to the back of the queue and is tried again once its backoff is
+    # up, so a failing page doesn't hold up the fetches behind it. Yields (item, result) as items finish, with result None for the
+    # items that ran out of attempts. With ordered, they're yielded in the order of items instead, holding back only the ones that
+    # finish ahead of an item still running.
+    def map(self, fn, items, concurrency, ordered=False):
+        items = iter(items)
+        end = object()
+        retries = [] # Heap of (notBefore, index, item, attempt)
+        index = itertools.count()
+        running = {}
+        finished = {} # index: (item, result) waiting for the items before it when ordered
+        nextIndex = 0
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            while True:
+                while len(running) < concurrency:
+                    item = next(items, end) if items is not None else end
+                    if item is not end:
+                        running[executor.submit(fn, item)] = (next(index), item, 1)
+                        continue
+                    items = None
+                    if len(retries) == 0 or retries[0][0] > time.monotonic():
+                        break
+                    _, i, item, attempt = heapq.heappop(retries)
+                    running[executor.submit(fn, item)] = (i, item, attempt)
+
+                if len(running) == 0:
+                    if len(retries) == 0:
+                        return
+                    time.sleep(max(0, retries[0][0] - time.monotonic()))
+                    continue
+
+                timeout = None if items is not None or len(retries) == 0 else max(0, retries[0][0] - time.monotonic())
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, item, attempt = running.pop(future)
+                    try:
+                        finished[i] = (item, future.result())
+                    except FetchFailed as e:
+                        if not self.giveUp(attempt, e):
+                            heapq.heappush(retries, (time.monotonic() + self.backoff(attempt), i, item, attempt + 1))
+                            continue
+                        print(f"Giving up on {item} after {attempt} attempts: {e}")
+                        finished[i] = (item, None)
+                    if not ordered:
+                        yield finished.pop(i)
+                while nextIndex in finished:
+                    yield finished.pop(nextIndex)
+                    nextIndex += 1
+
+
+class Scraper:
+
+    def __init__(self, pageCache, useSelenium=False):
+        # Steam workshop pages are server rendered, so plain HTTP is the default. Selenium is kept for pages that need a browser.
+        self.useSelenium = useSelenium
+        self.drivers = DriverPool(DRIVER_POOL_SIZE, DRIVER_MAX_PAGES)
+        self.session = requests.Session()
+        self.session.headers.update({ "User-Agent": USER_AGENT })
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.fetcher = FetchScheduler(self.session)
+        self.setTimezoneCookie()
         self.url = None
-        self.steamAccounts = list(STEAM_ACCOUNTS)
+        self.downloader = DepotDownloaderPool(STEAM_ACCOUNTS, self.identifyMapFromFiles)
         self.pageCache = pageCache
 
-    def __del__(self):
-        print("Killing selenium driver")
-        self.driver.quit()
+    # Steam renders Posted/Updated dates in the timezone its page script stores in this cookie, and clean_datetime reads
+    # them as local time. A browser sets it itself, plain HTTP has to send the local offset (in seconds east of UTC) too.
+    def setTimezoneCookie(self):
+        offset = int(datetime.datetime.now().astimezone().utcoffset().total_seconds())
+        self.session.cookies.set("timezoneOffset", f"{offset},0", domain=urlparse(STEAM_COMMUNITY_URL).hostname, path="/")
 
-    def getWorkshopIDs(self):
+    def __del__(self):
+        if getattr(self, "drivers", None) is not None:
+            self.drivers.shutdown()
+        if getattr(self, "session", None) is not None:
+            self.session.close()
+
+    # Returns the page source for url, or None if it couldn't be retrieved. Raises FetchFailed when it's worth trying again.
+    def fetchPage(self, url):
+        if self.useSelenium:
+            return self.fetchWithDriver(url, "#rightContents")
+        return self.fetchHttp(url)
+
+    def fetchHttp(self, url):
+        try:
+            response = self.fetcher.request("GET", url)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Request failed for {url}: {e}")
+            return None
+        return response.text
+
+    # Returns (pageSource, parsed) for url, going through the page cache under cacheKey. Expired pages are revalidated with a
+    # conditional GET. parsed holds the details stored with setParsed when this page content has been parsed before, so it
+    # needn't be parsed again. Raises FetchFailed when it's worth trying again.
+    def getCachedPage(self, url, cacheKey, browserFetch=None, revalidate=False):
+        def cached(pageSource, parsed):
+            if parsed is not None:
+                METRICS.count("parsedCacheHit")
+            return pageSource, parsed
+
+        entry = self.pageCache.lookup(cacheKey)
+        if entry is not None and entry["fresh"] and not revalidate:
+            METRICS.count("pageCacheHit")
+            return cached(entry["content"], entry["parsed"])
+        METRICS.count("pageCacheMiss")
+
+        if self.useSelenium:
+            with METRICS.stage("detailFetch"):
+                pageSource = (browserFetch or self.fetchPage)(url)
+            if pageSource is None:
+                return None, None
+            self.pageCache.setPage(cacheKey, pageSource)
+            return cached(pageSource, self.pageCache.getParsed(cacheKey))
+
+        headers = {}
+        if entry is not None and entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry["lastModified"] is not None:
+            headers["If-Modified-Since"] = entry["lastModified"]
+
+        with METRICS.stage("detailFetch"):
+            try:
+                response = self.fetcher.request("GET", url, headers=headers)
+                if response.status_code == 304 and entry is not None:
+                    METRICS.count("pageNotModified")
+                    self.pageCache.refresh(cacheKey)
+                    return cached(entry["content"], entry["parsed"])
+                response.raise_for_status()
+            except requests.RequestException as e:
+                METRICS.count("fetchError")
+                print(f"Request failed for {url}: {e}")
+                return None, None
+
+        # The server may not support conditional requests, the page can still be the same as what was parsed before
+        self.pageCache.setPage(cacheKey, response.text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return cached(response.text, self.pageCache.getParsed(cacheKey))
+
+    def getWorkshopIDs(self, isKnown=None):
+        return list(self.iterWorkshopIDs(isKnown))
+
+    # Crawls the browse pages newest first, yielding each id the first time it's seen as soon as its page is read. With isKnown,
+    # the crawl stops after the first page where isKnown is true for every id, as all the pages after it are older still.
+    # Returns False if a page couldn't be retrieved and the crawl stopped short.
+    def iterWorkshopIDs(self, isKnown=None):
         url = MOST_RECENT_URL
         ids = set()
         while True:
             print(f"Retrieving: {url}")
             sys.stdout.flush()
-            self.driver.get(url)
-            try:
-                WebDriverWait(self.driver, 10).until(
-                    EC.presence_of_element_located((
-                        By.ID, 'rightContents')))
-            except Exception as e:
-                print("FAILED TO GET WORKSHOP IDS FROM -> " + url)
+            with METRICS.stage("browseCrawl"):
+                pageSource = self.fetcher.retry(lambda: self.fetchPage(url), url)
+            if pageSource is None:
+                print("FAILED TO GET WORKSHOP IDS FROM -> " + url + ". May have missed some maps.")
                 sys.stdout.flush()
-                continue
+                return False
 
-            soup = BeautifulSoup(self.driver.page_source, "html.parser")
-            workshopItems = soup.find('div', { 'class': 'workshopBrowseItems' })
-            for a in workshopItems.findAll('a'):
-                link = a['href']
-                if 'filedetails' in link:
-                    workshopID = link[link.rfind('id=') + 3 : link.rfind('&')]
-                    ids.add(workshopID)
-            paging = soup.find('div', { 'class': 'workshopBrowsePagingControls' })
-            url = None
-            for btn in paging.findAll('a'):
-                if btn.contents[0] == '>':
-                    url = btn['href']
+            pageIds, url = extractBrowsePage(pageSource)
+            for id in pageIds:
+                if id not in ids:
+                    ids.add(id)
+                    yield id
             if url is None:
-                break
-            
+                return True
+            if isKnown is not None and len(pageIds) > 0 and all(isKnown(id) for id in pageIds):
+                print("Every map on this page is already known, stopping")
+                METRICS.count("browseEarlyStop")
+                return True
+
+    # Ids on the first page of each of urls, for watch mode's polls
+    def getRecentWorkshopIDs(self, urls):
+        ids = set()
+        for url in urls:
+            with METRICS.stage("browseCrawl"):
+                pageSource = self.fetcher.retry(lambda: self.fetchPage(url), url)
+            if pageSource is None:
+                print("FAILED TO GET WORKSHOP IDS FROM -> " + url)
+                continue
+            pageIds, _ = extractBrowsePage(pageSource)
+            ids.update(pageIds)
         return list(ids)
 
-    def getWorkshopDetails(self, id):
+    # With revalidate, a cached page is checked with the server even if it hasn't expired yet. Raises FetchFailed when it's worth trying again.
+    def getWorkshopDetails(self, id, revalidate=False):
         print("Getting workshop details for: " + str(id))
-        cacheData = self.pageCache.getWorkshopMapPage(id)
-        if cacheData is None:
-            self.driver.get(FILEDETAILS_URL.format(id))
-            try:
-                WebDriverWait(self.driver, 10).until(
-                        EC.presence_of_element_located((
-                            By.ID, 'rightContents')))
-            except Exception as e:
-                print(f"DROPPED STEAM MAP -> {id}")
-                sys.exit()
-
-            soup = BeautifulSoup(self.driver.page_source, "html.parser")
-            self.pageCache.setWorkshopMapPage(id, self.driver.page_source)
-        else:
-            soup = BeautifulSoup(cacheData, "html.parser")
-        
-        author_element = soup.find('div', {'class':'friendBlockContent'})
-        title_element = soup.find('div', {'class':'workshopItemTitle'})
-        description_element = soup.find('div', {'class':'workshopItemDescription', 'id':'highlightContent'})
-        detailsLeft = soup.find('div', { 'class': 'detailsStatsContainerLeft' })
-        detailsRight = soup.find('div', { 'class': 'detailsStatsContainerRight' })
-
-        if author_element is None or title_element is None or description_element is None or detailsLeft is None or detailsRight is None:
-            print(f"FAILED TO GET SOME DATA FOR -> {id}")
-            return None
-
-        
-        author = clean_str(author_element.contents[0])
-        title = clean_str(title_element.contents[0])
-        
-        desc = description_element.get_text('\n')
-        desc = desc.replace("~~", "")
-
-        published = None
-        lastUpdated = None
-        for i, div in enumerate(detailsLeft.findAll('div')):
-            if div.get_text().strip().lower() == "posted":
-                divsRight = detailsRight.findAll("div")
-                if len(divsRight) > i and '@' in divsRight[i].get_text():
-                    published = clean_datetime(divsRight[i].get_text())
-            elif div.get_text().strip().lower() == "updated":
-                divsRight = detailsRight.findAll("div")
-                if len(divsRight) > i and '@' in divsRight[i].get_text():
-                    lastUpdated = clean_datetime(divsRight[i].get_text())
-
-        if published is None:
-            print(f"FAILED TO GET PUBLISHED FOR -> {id}")
+        pageSource, details = self.getCachedPage(FILEDETAILS_URL.format(id), PageCache.workshopKey(id), revalidate=revalidate)
+        if pageSource is None:
+            print(f"DROPPED STEAM MAP -> {id}")
             return None
-
-        if lastUpdated is None:
-            lastUpdated = published
-
-        return { "title": title, "author": author, "desc": desc, "published": published, "lastUpdated": lastUpdated }
+        if details is not None:
+            return details
+
+        details = self.parseWorkshopDetails(id, pageSource)
+        if details is not None:
+            self.pageCache.setParsed(PageCache.workshopKey(id), details)
+        return details
+
+    def parseWorkshopDetails(self, id, pageSource):
+        with METRICS.stage("parse"):
+            return extractWorkshopDetails(id, pageSource)
+
+    # Fetches details for several ids at once, yielding (id, details) in the same order as ids. Pages that fail are retried after the rest.
+    def getWorkshopDetailsMany(self, ids, revalidate=False):
+        concurrency = DRIVER_POOL_SIZE if self.useSelenium else DETAILS_CONCURRENCY
+        return self.fetcher.map(lambda id: self.getWorkshopDetails(id, revalidate), ids, concurrency, ordered=True)
+
+    # Batched metadata from Steam's GetPublishedFileDetails, which needs no API key. Returns { id: { "title", "desc", "published", "lastUpdated" } }
+    # for the ids Steam knew about, or an empty dict if the request failed. It has no author name and the description is raw BBCode.
+    def getPublishedFileDetails(self, ids):
+        data = { "itemcount": len(ids) }
+        for i, id in enumerate(ids):
+            data[f"publishedfileids[{i}]"] = id
+        with METRICS.stage("apiFetch"):
+            try:
+                response = self.fetcher.retry(lambda: self.fetcher.request("POST", PUBLISHED_FILE_DETAILS_URL, data=data), f"GetPublishedFileDetails for {len(ids)} ids")
+                if response is None:
+                    return {}
+                response.raise_for_status()
+                files = response.json()["response"]["publishedfiledetails"]
+            except (requests.RequestException, ValueError, KeyError) as e:
+                METRICS.count("fetchError")
+                print(f"GetPublishedFileDetails failed for {len(ids)} ids: {e}")
+                return {}
+
+        details = {}
+        for f in files:
+            if f.get("result") != 1 or "time_created" not in f:
+                continue
+            details[str(f["publishedfileid"])] = {
+                "title": f.get("title"),
+                "desc": f.get("description"),
+                "published": f["time_created"],
+                "lastUpdated": f.get("time_updated") or f["time_created"]
+            }
+        return details
 
     def getWorkshopMapFile(self, id, doUpdate):
         dirPath = os.path.join(WORKSHOP_PATH, id)
@@ -253,53 +1285,11 @@ class Scraper:
                     return os.path.join(dirPath, f)
             # If this fails, it falls through to update
 
-        print("Downloading workshop files for: " + str(id))
-        sys.stdout.flush()
-        while len(self.steamAccounts) > 0:
-            steamIdx = randint(0, len(self.steamAccounts) - 1)
-            steamUser, steamPass = self.steamAccounts[steamIdx]
-            cmd = DepotDownloaderCommand.format(id, steamUser, steamPass, dirPath)
-
-            process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE)
-            mapFiles = []
-            lines = []
-            
-            unescapedWorkshopPath = WORKSHOP_PATH.replace('\\\\', '\\')
-            while True:
-                line = process.stdout.readline()
-                if not line or (line == '' and process.poll() is not None):
-                    break
-                if line:
-                    line = line.decode('iso-8859-1').strip()
-                    lines.append(line)
-                    if (".udk" in line or ".upk" in line or ".umap" in line) and unescapedWorkshopPath in line:
-                        mapFiles.append(line[line.find(unescapedWorkshopPath):].replace('\n',''))
-                    elif "RateLimitedExceeded" in line:
-                        self.steamAccounts = self.steamAccounts[:steamIdx] + self.steamAccounts[steamIdx + 1:]
-                    elif "Encountered error" in line and "NotFound" in line:
-                        process.kill()
-                        print(f"ABORTING DOWNLOAD FOR -> {id}. Error: {line}")
-                        return None
-            if len(mapFiles) == 0:
-                print(f"FAILED TO GET MAP FILE FOR -> {id}. Command: {cmd}")
-                print('\n'.join(lines).encode('utf-8', errors='ignore'))
-                return None
-            return self.identifyMapFromFiles(mapFiles)
-
-            '''
-            stream = os.popen(cmd)
-            output = stream.readlines()
-            mapFile = None
-            for line in output:
-                if (".udk" in line or ".upk" in line) and WORKSHOP_PATH in line:
-                    mapFile = line[line.find(WORKSHOP_PATH):].replace('\n','')
-                if "RateLimitExceeded" in line:
-                    self.steamAccounts = self.steamAccounts[:steamIdx] + self.steamAccounts[steamIdx + 1:]
-            if mapFile is None:
-                print(f"FAILED TO GET MAP FILE FOR -> {id}. Command: {cmd}")
-                print(''.join(output))
-            return mapFile
-            '''
+        return self.downloadWorkshopMapFile(id).result()
+
+    # Queues id on the DepotDownloader pool and returns a Future for its map file
+    def downloadWorkshopMapFile(self, id):
+        return self.downloader.submit(id)
 
     def getWorkshopMapFileFromSteamFolder(self, workshopId):
         dirPath = os.path.join(STEAM_WORKSHOP_PATH, workshopId)
@@ -311,11 +1301,13 @@ class Scraper:
                 return None
             mapFile = self.identifyMapFromFiles(mapFiles)
             target = os.path.join(WORKSHOP_PATH, workshopId, os.path.basename(mapFile))
-            if not os.path.exists(mapFile):
-                os.makedirs(os.path.join(WORKSHOP_PATH, workshopId))
-                print(f"Copying file {mapFile} to {target}")
-                shutil.copyfile(mapFile, target)
-            return mapFile
+            os.makedirs(os.path.join(WORKSHOP_PATH, workshopId), exist_ok=True)
+            print(f"Copying file {mapFile} to {target}")
+            # The old file may be linked into the blob store, copying over it would change the blob too
+            if os.path.exists(target):
+                os.remove(target)
+            shutil.copyfile(mapFile, target)
+            return target
         else:
             print(f"FAILED TO LOCATE FOLDER IN STEAM WORKSHOP PATH FOR -> {workshopId}")
 
@@ -333,52 +1325,136 @@ class Scraper:
         return largestMapFile["file"]
 
     
+    # Loads url in the browser and returns the page source once an element matching readyCss is there. Raises FetchFailed if it never
+    # shows up or the browser failed, as the browser can't tell a slow page from a missing one.
+    def fetchWithDriver(self, url, readyCss):
+        throttle = self.fetcher.throttle(url)
+        try:
+            with throttle, self.drivers.checkout() as driver:
+                driver.get(url)
+                try:
+                    WebDriverWait(driver, BROWSER_WAIT_TIMEOUT).until(EC.presence_of_element_located((By.CSS_SELECTOR, readyCss)))
+                except Exception:
+                    pageSource = None
+                else:
+                    pageSource = driver.page_source
+        except WebDriverException as e:
+            throttle.backOff()
+            raise FetchFailed(f"{url}: {e}") from e
+        if pageSource is None:
+            throttle.backOff()
+            raise FetchFailed(f"timed out waiting for {readyCss} on {url}")
+        throttle.succeeded()
+        return pageSource
+
     def getLethMaps(self):
+        return list(self.iterLethMaps())
+
+    # Yields each map post's link the first time it's seen, page by page
+    def iterLethMaps(self):
         url = LETHS_MAPS_START_URL
-        links = []
+        links = set()
         while True:
             print(f"Retrieving: {url}")
             sys.stdout.flush()
 
-            self.driver.get(url)
-            time.sleep(5)
+            with METRICS.stage("lethCrawl"):
+                if self.useSelenium:
+                    pageSource = self.fetcher.retry(lambda: self.fetchWithDriver(url, "nav.blog-list-pagination"), url)
+                else:
+                    pageSource = self.fetcher.retry(lambda: self.fetchPage(url), url)
+            if pageSource is None:
+                print(f"Failed to retrieve {url}. May have missed some maps.")
+                return
 
-            soup = BeautifulSoup(self.driver.page_source, "html.parser")
+            soup = BeautifulSoup(pageSource, "html.parser")
             articles = soup.findAll('article', { 'class': 'blog-item' })
             for article in articles:
                 for a in article.findAll('a', { 'class': 'blog-more-link' }):
-                    links.append("https://lethamyr.com" + a['href'])
+                    link = LETHAMYR_URL + a['href']
+                    if link not in links:
+                        links.add(link)
+                        yield link
 
             pagination = soup.find('nav', { 'class': 'blog-list-pagination' })
             if pagination is None:
                 print(f"Failed to find pagination in {url}. May have missed some maps.")
-                return links
+                return
             
             older = pagination.find('div', { 'class': 'older' })
             if older is None:
                 print(f"Failed to find older posts in {url}. May have missed some maps.")
-                return links
+                return
 
             olderPosts = older.find('a')
             if olderPosts is None:
-                return links # We should be done if this is missing
+                return # We should be done if this is missing
             
-            url = "https://lethamyr.com" + olderPosts["href"]
-    
+            url = LETHAMYR_URL + olderPosts["href"]
 
+    # Returns { link: lastmod timestamp } from the site's sitemap, or None if it couldn't be read
+    def getLethLastModified(self):
+        pageSource = self.fetcher.retry(lambda: self.fetchHttp(LETHS_SITEMAP_URL), LETHS_SITEMAP_URL)
+        if pageSource is None:
+            return None
+        try:
+            root = etree.fromstring(pageSource.encode('utf-8'))
+        except etree.XMLSyntaxError as e:
+            print(f"Failed to parse {LETHS_SITEMAP_URL}: {e}")
+            return None
+        ns = { "sm": "http://www.sitemaps.org/schemas/sitemap/0.9" }
+        lastModified = {}
+        for url in root.iterfind("sm:url", ns):
+            loc = url.findtext("sm:loc", namespaces=ns)
+            lastmod = url.findtext("sm:lastmod", namespaces=ns)
+            if loc is None or lastmod is None:
+                continue
+            lastmod = lastmod.strip()
+            if "T" in lastmod:
+                ts = datetime.datetime.fromisoformat(lastmod.replace("Z", "+00:00"))
+            else:
+                # Date only, so the post may have changed any time that day
+                ts = datetime.datetime.fromisoformat(lastmod).replace(tzinfo=datetime.timezone.utc) + datetime.timedelta(days=1)
+            lastModified[urlparse(loc).path.rstrip("/")] = int(ts.timestamp())
+        return lastModified
+
+    # Yields the links that aren't already in the catalog or whose post the sitemap says has changed since `since`
+    def lethLinksToUpdate(self, links, knownLinks, since):
+        lastModified = None
+        if since is not None and "fullLeth" not in sys.argv:
+            lastModified = self.getLethLastModified()
+        for link in links:
+            lastmod = lastModified.get(urlparse(link).path.rstrip("/")) if lastModified is not None else None
+            if link in knownLinks and lastmod is not None and lastmod < since:
+                continue
+            yield link
+
+
+    # Raises FetchFailed when it's worth trying again
     def getLethMapDetails(self, link):
         print("Getting leth map details for: " + link)
-        cacheData = self.pageCache.getLethMapPage(link)
-        soup = None
-        if cacheData is None:
-            self.driver.get(link)
-            time.sleep(2)
-
-            dom = etree.HTML(self.driver.page_source)
-            self.pageCache.setLethMapPage(link, self.driver.page_source)
-        else:
-            dom = etree.HTML(cacheData)
+        pageSource, details = self.getCachedPage(link, PageCache.lethKey(link), self.fetchLethPageWithDriver)
+        if pageSource is None:
+            print(f"FAILED TO GET MAP DETAILS FOR -> {link}")
+            return None
+        if details is not None:
+            return details
+
+        with METRICS.stage("parse"):
+            details = self.parseLethMapDetails(link, pageSource)
+        if details is not None:
+            self.pageCache.setParsed(PageCache.lethKey(link), details)
+        return details
+
+    def fetchLethPageWithDriver(self, link):
+        return self.fetchWithDriver(link, 'h1[data-content-field="title"]')
 
+    # Fetches the details of each link concurrently, yielding (link, details) in link order. Pages that fail are retried after the rest.
+    def getLethMapDetailsMany(self, links):
+        return self.fetcher.map(self.getLethMapDetails, links, DETAILS_CONCURRENCY, ordered=True)
+
+    def parseLethMapDetails(self, link, pageSource):
+        dom = etree.HTML(pageSource)
         titleEl = dom.xpath('//h1[@data-content-field="title"]')
         descEl = dom.xpath('//h3[text()="Description"]/following-sibling::p')
         downloadLink = dom.xpath('//a[normalize-space(text())="Download"]')
@@ -390,21 +1466,34 @@ class Scraper:
         return { "title": titleEl[0].text, "desc": descEl[0].text, "link": link, "download": downloadLink[0].attrib['href'] }
 
     
-    def getLethMapFile(self, mapDetails):
+    # Downloads the map's Google Drive archive and extracts its .udk and .json into WORKSHOP_PATH/<title>. The .udk is hashed as it's
+    # extracted and the hashes go into hashCache, so it's never read back. The archive itself is only kept until it's extracted.
+    def getLethMapFile(self, mapDetails, hashCache=None):
         fileId = mapDetails["download"]
         fileId = fileId[fileId.rfind("/file/d/") + 8 : fileId.rfind("/")]
-        dest = os.path.join(WORKSHOP_PATH, clean_path(mapDetails["title"].replace(" ", "-")) + ".zip")
+        downloadsPath = os.path.join(WORKSHOP_PATH, ".leth")
+        archive = os.path.join(downloadsPath, fileId + ".zip")
+        extracted = os.path.join(downloadsPath, fileId + ".done") # Left once the archive is extracted, so it isn't downloaded again
+        legacyArchive = os.path.join(WORKSHOP_PATH, clean_path(mapDetails["title"].replace(" ", "-")) + ".zip")
         destFolder = os.path.join(WORKSHOP_PATH, clean_path(mapDetails["title"]))
-
-        if not os.path.exists(dest):
-            gdd.download_file_from_google_drive(file_id=fileId, dest_path=dest, unzip=True)
-
-        # Do folder rename before processing files as the folder might not have been extracted this run
-        if os.path.exists(dest) and not os.path.exists(destFolder):
-            folderName = zipfile.ZipFile(dest).namelist()[0]
-            folderName = folderName[: folderName.find('/')]
-            if folderName != clean_path(mapDetails["title"]):
-                shutil.move(os.path.join(WORKSHOP_PATH, folderName), destFolder)
+        os.makedirs(downloadsPath, exist_ok=True)
+
+        hasMapFile = os.path.exists(destFolder) and any(f.endswith(".udk") for f in os.listdir(destFolder))
+        if hasMapFile and os.path.exists(legacyArchive):
+            # Extracted by the old gdd download, which kept the whole archive next to the folder
+            open(extracted, 'w').close()
+            os.remove(legacyArchive)
+        if not hasMapFile or not os.path.exists(extracted):
+            if not self.downloadFromDrive(fileId, archive):
+                return None
+            try:
+                self.extractLethArchive(archive, destFolder, hashCache)
+            except zipfile.BadZipFile as e:
+                print(f"FAILED TO EXTRACT LETH MAP ARCHIVE FOR -> {mapDetails['title']}. Error: {e}")
+                os.remove(archive)
+                return None
+            open(extracted, 'w').close()
+            os.remove(archive)
 
         mapFile = None
         if os.path.exists(destFolder):
@@ -422,6 +1511,171 @@ class Scraper:
         mapDetails["filename"] = mapFile
         return mapDetails
 
+    # Downloads a Google Drive file to dest, resuming a partial download with a Range request. Large files get a virus scan warning
+    # page instead of the file, which has the confirm token to ask for the file anyway.
+    def downloadFromDrive(self, fileId, dest):
+        url = GOOGLE_DRIVE_DOWNLOAD_URL
+        params = { "export": "download", "id": fileId }
+        attempt = 0
+        while attempt < LETH_DOWNLOAD_ATTEMPTS:
+            headers = {}
+            offset = os.path.getsize(dest) if os.path.exists(dest) else 0
+            if offset > 0:
+                headers["Range"] = f"bytes={offset}-"
+            try:
+                with self.fetcher.request("GET", url, params=params, headers=headers, stream=True) as response:
+                    if response.status_code == 416:
+                        return True # Range starts at the end, we already have all of it
+                    response.raise_for_status()
+                    if response.headers.get("Content-Type", "").startswith("text/html"):
+                        if "confirm" in params:
+                            print(f"FAILED TO GET GOOGLE DRIVE DOWNLOAD FOR -> {fileId}")
+                            return False
+                        page = response.text
+                        form = re.search(r'<form[^>]+action="([^"]+)"', page)
+                        confirm = next((v for k, v in response.cookies.items() if k.startswith("download_warning")), None)
+                        if form is not None:
+                            # The warning page's form carries the id, confirm token and whatever else the download needs
+                            url = form.group(1).replace("&amp;", "&")
+                            params = dict(re.findall(r'<input type="hidden" name="([^"]+)" value="([^"]*)"', page))
+                        elif confirm is not None:
+                            params["confirm"] = confirm
+                        if "confirm" not in params:
+                            print(f"FAILED TO GET GOOGLE DRIVE DOWNLOAD FOR -> {fileId}")
+                            return False
+                        continue
+                    # A server that ignores the Range header sends the whole file again
+                    written = 0
+                    with open(dest, 'ab' if response.status_code == 206 else 'wb') as fp:
+                        for chunk in response.iter_content(HASH_CHUNK_SIZE):
+                            fp.write(chunk)
+                            written += len(chunk)
+                    expected = response.headers.get("Content-Length")
+                    if expected is None or written >= int(expected):
+                        return True
+                    error = f"connection closed after {written} of {expected} bytes"
+            except (requests.RequestException, FetchFailed) as e:
+                error = e
+            attempt += 1
+            print(f"Download of {fileId} failed at {offset} bytes ({error}), attempt {attempt} of {LETH_DOWNLOAD_ATTEMPTS}")
+            if attempt >= LETH_DOWNLOAD_ATTEMPTS or not self.fetcher.spendErrorBudget():
+                break
+            time.sleep(self.fetcher.backoff(attempt))
+        return False
+
+    # Extracts only the .udk and .json members of archive, flattened into destFolder, hashing the .udk on the way
+    def extractLethArchive(self, archive, destFolder, hashCache=None):
+        os.makedirs(destFolder, exist_ok=True)
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                name = os.path.basename(info.filename)
+                isMap = name.lower().endswith(".udk")
+                if info.is_dir() or not (isMap or name.lower().endswith(".json")):
+                    continue
+                target = os.path.join(destFolder, name)
+                digests = HashDetails.newDigests() if isMap else {}
+                with zf.open(info) as src, open(target + ".tmp", 'wb') as dst:
+                    while True:
+                        chunk = src.read(HASH_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        for digest in digests.values():
+                            digest.update(chunk)
+                os.replace(target + ".tmp", target)
+                if isMap and hashCache is not None:
+                    hashCache.set(target, { key: digest.hexdigest() for key, digest in digests.items() })
+                    METRICS.count("bytesHashedOnExtract", info.file_size)
+
+
+class HashCache:
+    # Remembers the digests of map files keyed by path and file identity (size, mtime, inode), so unchanged files are never read again.
+    # The file carries a checksum of its entries and is thrown away if it doesn't match or was written for different hash algorithms.
+    # New entries are appended to a log next to it as they're hashed, each with its own checksum, and folded into the file by save.
+
+    VERSION = 1
+
+    def __init__(self, path, forceRehash=False):
+        self.path = path
+        self.forceRehash = forceRehash
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.log = Journal(path + ".log")
+        self.savedEntries = 0 # Entries in the file when it was last written
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as fp:
+                    data = json.load(fp)
+                if not HashCache.isCurrent(data):
+                    print(f"Hash cache {path} is from a different version, ignoring it")
+                elif data.get("checksum") != HashCache.checksum(data["entries"]):
+                    print(f"Hash cache {path} failed its checksum, ignoring it")
+                else:
+                    self.entries = data["entries"]
+                    self.savedEntries = len(self.entries)
+            except (ValueError, KeyError, OSError) as e:
+                print(f"Failed to load hash cache {path}: {e}")
+        records = self.log.read()
+        for record in records:
+            if HashCache.isCurrent(record) and record.get("checksum") == HashCache.checksum(record.get("entry")):
+                self.entries[record["path"]] = record["entry"]
+        self.log.events = len(records)
+        self.dirty = len(records) > 0
+        # Drop entries for files that no longer exist
+        self.entries = { fpath: entry for fpath, entry in self.entries.items() if os.path.exists(fpath) }
+
+    @staticmethod
+    def isCurrent(data):
+        return data.get("version") == HashCache.VERSION and data.get("algorithms") == [ HASH_ALG, FAST_HASH_ALG ]
+
+    @staticmethod
+    def checksum(entries):
+        return hashlib.sha256(json.dumps(entries, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def identity(fpath):
+        st = os.stat(fpath)
+        return { "size": st.st_size, "mtimeNs": st.st_mtime_ns, "inode": st.st_ino }
+
+    # Returns the cached hashes for fpath, or None if the file changed since it was hashed
+    def get(self, fpath):
+        if self.forceRehash:
+            return None
+        entry = self.entries.get(os.path.abspath(fpath))
+        if entry is None or entry["identity"] != HashCache.identity(fpath):
+            return None
+        return dict(entry["hashes"])
+
+    # Logged straight away, so a run that's killed doesn't have to hash the file again
+    def set(self, fpath, hashes, identity=None):
+        with self.lock:
+            fpath = os.path.abspath(fpath)
+            entry = { "identity": identity or HashCache.identity(fpath), "hashes": dict(hashes) }
+            self.entries[fpath] = entry
+            self.dirty = True
+            self.log.append({ "version": HashCache.VERSION, "algorithms": [ HASH_ALG, FAST_HASH_ALG ], "path": fpath, "entry": entry, "checksum": HashCache.checksum(entry) })
+            # Folding the log in rewrites every entry, so only do it once the log is as long as the file. That keeps it O(1) per entry.
+            if self.log.events >= max(JOURNAL_COMPACT_EVERY, self.savedEntries):
+                self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmpPath = self.path + ".tmp"
+            with open(tmpPath, 'w') as fp:
+                json.dump({
+                    "version": HashCache.VERSION,
+                    "algorithms": [ HASH_ALG, FAST_HASH_ALG ],
+                    "checksum": HashCache.checksum(self.entries),
+                    "entries": self.entries
+                }, fp)
+            os.replace(tmpPath, self.path)
+            self.savedEntries = len(self.entries)
+            self.log.truncate()
+            self.dirty = False
+
 
 class HashDetails:
 
@@ -445,46 +1699,288 @@ class HashDetails:
             segmentHash.update(fp.read(self.segment["length"]))
         return str(fsize) + ":" + segmentHash.hexdigest()
 
+    # Finds the smallest segment (offset, length) whose segment hash tells apart every file in fpaths, which should all have different
+    # content. Segment hashes are prefixed with the file size, so only files of the same size need a segment where they differ.
+    # Those are read once, front to back and only as far as needed, into a SegmentIndex. Candidate segments are then compared in
+    # O(1) each through the indexes' rolling hashes. Returns None if no segment of up to SEGMENT_MAX_LENGTH bytes works.
+    @staticmethod
+    def findUniqueSegment(fpaths):
+        sizes = { fpath: os.path.getsize(fpath) for fpath in fpaths }
+        if len(sizes) == 0:
+            return { "offset": 0, "length": SEGMENT_MIN_LENGTH }
+        # The segment has to fit in every file
+        limit = min(sizes.values()) // SEGMENT_BLOCK_SIZE * SEGMENT_BLOCK_SIZE
+        if limit < SEGMENT_MIN_LENGTH:
+            return None
+
+        bySize = {}
+        for fpath, size in sizes.items():
+            bySize.setdefault(size, []).append(fpath)
+        indexes = { fpath: SegmentIndex(fpath) for group in bySize.values() if len(group) > 1 for fpath in group }
+        groups = [ [ indexes[fpath] for fpath in group ] for group in bySize.values() if len(group) > 1 ]
+        METRICS.count("segmentCollisionFiles", len(indexes))
+
+        try:
+            end = min(SEGMENT_FIRST_READ, limit)
+            while True:
+                for index in indexes.values():
+                    index.extend(end)
+                blocks = end // SEGMENT_BLOCK_SIZE
+                for length in range(SEGMENT_MIN_LENGTH, SEGMENT_MAX_LENGTH + 1, SEGMENT_BLOCK_SIZE):
+                    n = length // SEGMENT_BLOCK_SIZE
+                    for start in range(0, blocks - n + 1):
+                        if all(len(set(index.window(start, n) for index in group)) == len(group) for group in groups):
+                            return { "offset": start * SEGMENT_BLOCK_SIZE, "length": length }
+                if end >= limit:
+                    return None
+                end = min(end * 8, limit)
+        finally:
+            for index in indexes.values():
+                index.close()
+
+    @staticmethod
+    def newDigests():
+        return { "fullHash": hashlib.new(HASH_ALG), "fastHash": hashlib.new(FAST_HASH_ALG, digest_size=FAST_HASH_DIGEST_SIZE) }
+
+    # Streams the file once through every digest we store, using a fixed size buffer so big maps aren't loaded into memory
+    @staticmethod
+    def computeFileHashes(fpath):
+        digests = HashDetails.newDigests()
+        buf = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buf)
+        with open(fpath, mode='rb', buffering=0) as fp:
+            while True:
+                n = fp.readinto(buf)
+                if not n:
+                    break
+                for digest in digests.values():
+                    digest.update(view[:n])
+        return { name: digest.hexdigest() for name, digest in digests.items() }
+
     @staticmethod
     def computeFullHash(fpath):
-        fullHash = hashlib.md5()
-        with open(fpath, mode='rb') as fp:
-            fullHash.update(fp.read())
-            return fullHash.hexdigest()
+        return HashDetails.computeFileHashes(fpath)["fullHash"]
 
+    # Hashes several files, returning { fpath: hashes }. Files found unchanged in hashCache aren't read. hashlib releases the GIL
+    # while it digests, so callers hashing on several threads use every core without a process pool.
+    @staticmethod
+    def computeFileHashesMany(fpaths, hashCache=None):
+        results = {}
+        misses = []
+        for fpath in sorted(set(fpaths)):
+            cached = hashCache.get(fpath) if hashCache is not None else None
+            if cached is None:
+                misses.append(fpath)
+            else:
+                results[fpath] = cached
+
+        # Take the file identity before reading so a file modified mid-hash is hashed again next time
+        identities = { fpath: HashCache.identity(fpath) for fpath in misses }
+        METRICS.count("hashCacheHit", len(results))
+        METRICS.count("filesHashed", len(misses))
+        METRICS.count("bytesHashed", sum(identity["size"] for identity in identities.values()))
+        with METRICS.stage("hash"):
+            hashed = { fpath: HashDetails.computeFileHashes(fpath) for fpath in misses }
+
+        if hashCache is not None:
+            for fpath, hashes in hashed.items():
+                hashCache.set(fpath, hashes, identities[fpath])
+        results.update(hashed)
+        return results
+
+
+class SegmentIndex:
+    # Polynomial rolling hash over the SEGMENT_BLOCK_SIZE blocks of a file, so the hash of any run of whole blocks is O(1).
+    # Two runs of blocks with different hashes have different bytes. Equal hashes almost always mean equal bytes, and a rare
+    # false match only makes findUniqueSegment skip a segment that would have worked.
+
+    MOD = (1 << 61) - 1
+    BASE = 0x5bd1e9955bd1e995 % ((1 << 61) - 1)
+
+    def __init__(self, fpath):
+        self.fp = open(fpath, 'rb')
+        self.prefix = [ 0 ]
+        self.powers = {}
+
+    def extend(self, end):
+        while (len(self.prefix) - 1) * SEGMENT_BLOCK_SIZE < end:
+            data = self.fp.read(min(HASH_CHUNK_SIZE, end - (len(self.prefix) - 1) * SEGMENT_BLOCK_SIZE))
+            if len(data) < SEGMENT_BLOCK_SIZE:
+                return
+            METRICS.count("segmentBytesRead", len(data))
+            h = self.prefix[-1]
+            for i in range(0, len(data) - SEGMENT_BLOCK_SIZE + 1, SEGMENT_BLOCK_SIZE):
+                block = int.from_bytes(hashlib.blake2b(data[i : i + SEGMENT_BLOCK_SIZE], digest_size=8).digest(), 'little')
+                h = (h * SegmentIndex.BASE + block) % SegmentIndex.MOD
+                self.prefix.append(h)
+
+    # Hash of the n blocks starting at block start
+    def window(self, start, n):
+        if n not in self.powers:
+            self.powers[n] = pow(SegmentIndex.BASE, n, SegmentIndex.MOD)
+        return (self.prefix[start + n] - self.prefix[start] * self.powers[n]) % SegmentIndex.MOD
+
+    def close(self):
+        self.fp.close()
+
+
+class BlobStore:
+    # Content addressed store of workshop map files, one file per distinct fullHash at <path>/<first 2 hex chars>/<fullHash>.
+    # The working files DepotDownloader writes into WORKSHOP_PATH/<id> and the per-version history directories are hardlinks
+    # to these, so a map republished with identical bytes takes no extra space. A blob nothing links to any more has a link
+    # count of 1 and is removed by gc.
+
+    def __init__(self, path):
+        self.path = path
+
+    def blobPath(self, fullHash):
+        return os.path.join(self.path, fullHash[:2], fullHash)
+
+    def has(self, fullHash):
+        return os.path.exists(self.blobPath(fullHash))
+
+    # Stores fpath under fullHash. If the blob already exists, fpath is replaced by a link to it.
+    def add(self, fpath, fullHash):
+        blob = self.blobPath(fullHash)
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, fpath):
+                METRICS.count("blobDedupBytes", os.path.getsize(fpath))
+                BlobStore.link(blob, fpath)
+            return blob
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(fpath, blob)
+        except OSError:
+            # Filesystem without hardlinks, the store still works but doesn't save any space
+            shutil.copyfile(fpath, blob + ".tmp")
+            os.replace(blob + ".tmp", blob)
+        METRICS.count("blobsAdded")
+        return blob
+
+    # Points target at the same file as source, replacing whatever target was
+    @staticmethod
+    def link(source, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = target + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+
+    # Gives every hardlinked file directly in dirPath its own copy, so a program writing into the files in place (DepotDownloader
+    # patching a map to its new version) can't change the blobs they're linked to
+    @staticmethod
+    def breakLinks(dirPath):
+        if not os.path.isdir(dirPath):
+            return
+        for f in os.listdir(dirPath):
+            fpath = os.path.join(dirPath, f)
+            if os.path.isfile(fpath) and os.stat(fpath).st_nlink > 1:
+                shutil.copyfile(fpath, fpath + ".tmp")
+                os.replace(fpath + ".tmp", fpath)
+
+    # Removes blobs that no working file or history directory links to any more
+    def gc(self):
+        removed = 0
+        freed = 0
+        if not os.path.isdir(self.path):
+            return removed, freed
+        for shard in os.listdir(self.path):
+            shardPath = os.path.join(self.path, shard)
+            if not os.path.isdir(shardPath):
+                continue
+            for f in os.listdir(shardPath):
+                st = os.stat(os.path.join(shardPath, f))
+                if st.st_nlink == 1:
+                    os.remove(os.path.join(shardPath, f))
+                    removed += 1
+                    freed += st.st_size
+            if len(os.listdir(shardPath)) == 0:
+                os.rmdir(shardPath)
+        return removed, freed
+
+
+# One downloaded version of a workshop map. fastHash is None for files hashed before it was added, segmentHash is only set by
+# generateUniqueSegmentHashes.
+@dataclass
+class MapFile:
+    __slots__ = ("filename", "fullHash", "fastHash", "updateTimestamp", "segmentHash")
+    filename: str
+    fullHash: str
+    fastHash: str
+    updateTimestamp: int
+    segmentHash: str
 
-class WorkshopMap:
+    @staticmethod
+    def fromDict(d):
+        return MapFile(d["filename"], d["fullHash"], d.get("fastHash"), d["updateTimestamp"], d.get("segmentHash"))
 
-    def __init__(self, workshopId, author, title, desc, published, mapFileHistory):
-        self.workshopId = workshopId
-        self.author = author
-        self.title = title
-        self.desc = desc
-        self.published = published
-        self.mapFileHistory = mapFileHistory
+    # Key order matches what jsonpickle used to write, so the release files don't change
+    def toDict(self):
+        d = { "filename": self.filename, "fullHash": self.fullHash }
+        if self.fastHash is not None:
+            d["fastHash"] = self.fastHash
+        d["updateTimestamp"] = self.updateTimestamp
+        if self.segmentHash is not None:
+            d["segmentHash"] = self.segmentHash
+        return d
+
+
+@dataclass
+class WorkshopMap:
+    __slots__ = ("workshopId", "author", "title", "desc", "published", "mapFileHistory")
+    workshopId: str
+    author: str
+    title: str
+    desc: str
+    published: int
+    mapFileHistory: list
 
-    # Copies existing map files into a directory named after the latest timestamp in mapFileHistory
+    @staticmethod
+    def fromDict(d):
+        return WorkshopMap(d["workshopId"], d["author"], d["title"], d["desc"], d["published"], [ MapFile.fromDict(f) for f in d["mapFileHistory"] ])
+
+    def toDict(self):
+        return {
+            "workshopId": self.workshopId,
+            "author": self.author,
+            "title": self.title,
+            "desc": self.desc,
+            "published": self.published,
+            "mapFileHistory": [ f.toDict() for f in self.mapFileHistory ]
+        }
+
+    # Keeps every version in mapFileHistory at WORKSHOP_PATH/<id>/<updateTimestamp>/<filename>, as hardlinks into the blob store.
     # This is done to maintain those files as DepotDownloader might update them with a new version
     # We might need to change the segment, so this makes it possible to change history
-    def backupExistingFiles(self):
-        mapFile = self.getLatestMapFile()
-        if mapFile is None:
+    # The current working file is stored first, hashed through hashCache, so mirrors from before the blob store keep their latest version.
+    def backupExistingFiles(self, blobStore, hashCache=None):
+        latest = self.getLatestMapFile()
+        if latest is None:
             return
-        newPath = os.path.join(WORKSHOP_PATH, self.workshopId, mapFile["updateTimestamp"])
-        if not os.path.exists(newPath):
-            os.makedirs(newPath)
-
-        for f in os.listdir(os.path.join(WORKSHOP_PATH, self.workshopId)):
-            if os.path.isdir(f): continue
-            if os.path.exists(os.path.join(newPath, f)): continue
-            shutil.copyfile(os.path.join(WORKSHOP_PATH, f), newPath)
+        workingFile = os.path.join(WORKSHOP_PATH, self.workshopId, latest.filename)
+        if os.path.isfile(workingFile):
+            hashes = HashDetails.computeFileHashesMany([ workingFile ], hashCache)[workingFile]
+            blobStore.add(workingFile, hashes["fullHash"])
+        self.linkHistory(blobStore)
+
+    def linkHistory(self, blobStore):
+        for mapFile in self.mapFileHistory:
+            if not blobStore.has(mapFile.fullHash):
+                continue
+            historyFile = os.path.join(WORKSHOP_PATH, self.workshopId, str(mapFile.updateTimestamp), mapFile.filename)
+            if not os.path.exists(historyFile):
+                BlobStore.link(blobStore.blobPath(mapFile.fullHash), historyFile)
 
     def getLatestMapFile(self):
         if len(self.mapFileHistory) == 0:
             return None
         latestFile = self.mapFileHistory[0]
         for f in self.mapFileHistory:
-            if f["updateTimestamp"] > latestFile["updateTimestamp"]:
+            if f.updateTimestamp > latestFile.updateTimestamp:
                 latestFile = f
         return latestFile
 
@@ -492,38 +1988,230 @@ class WorkshopMap:
         lastestFile = self.getLatestMapFile()
         if lastestFile is None:
             return 0
-        return lastestFile["updateTimestamp"]
+        return lastestFile.updateTimestamp
 
-    def addMapFile(self, mapFile, updateTimestamp):#, hashDetails):
+    def addMapFile(self, mapFile, updateTimestamp, hashes=None):#, hashDetails):
         if updateTimestamp < self.getLastUpdate():
             return
         #fullHash, segmentHash = hashDetails.computeHashes(mapFile)
-        fullHash = HashDetails.computeFullHash(mapFile)
-        self.mapFileHistory.append({
-            "filename": os.path.basename(mapFile),
-            "fullHash": fullHash,
-            #"segmentHash": segmentHash, # Fuck it, just use full hash
-            "updateTimestamp": updateTimestamp
-        })
+        if hashes is None:
+            hashes = HashDetails.computeFileHashes(mapFile)
+        entry = MapFile(os.path.basename(mapFile), hashes["fullHash"], hashes["fastHash"], updateTimestamp, None)
+        self.mapFileHistory.append(entry)
+        return entry
+
+
+class Journal:
+    # Append-only log of the changes made to a WorkshopManager during a run, one json event per line, flushed to disk as each map
+    # completes. If a run dies, the next one replays it on top of the last build json instead of downloading and hashing everything again.
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+        self.events = 0
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        events = []
+        with open(self.path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # A crash mid-write leaves a torn last line
+                    print(f"Skipping unreadable journal line in {self.path}")
+        return events
+
+    def append(self, event):
+        if self.fp is None:
+            self.fp = open(self.path, 'a', encoding='utf-8')
+        self.fp.write(json.dumps(event) + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.events += 1
+
+    def truncate(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.events = 0
 
 
 class WorkshopManager:
 
+    # Layout of the build json. Bump it when the layout changes and teach fromBuild to read the old one.
+    #   { "version": 1, "lastCheck": int, "lastModified": int, "maps": { id: map }, "hashDetails": { "algorithm", "segment" }, "lastFullSweep": int,
+    #     "retryIds": [ id ] }
+    # hashDetails is only there once segment hashes have been generated, lastFullSweep once the browse pages have been crawled in full,
+    # retryIds while some workshop maps are waiting to be retried.
+    # Workshop maps are WorkshopMap.toDict() and are told apart from the Leth maps (plain details dicts) by their "mapFileHistory".
+    # The maps keep their insertion order, which is also the order they're released in.
+    SCHEMA_VERSION = 1
+
     @staticmethod
     def fromJson(jsonPath):
         if os.path.exists(jsonPath):
-            with open(jsonPath, 'r') as fp:
-                wm = jsonpickle.decode(fp.read())
-                shutil.copyfile(BUILD_JSON_PATH, f"{BUILD_JSON_PATH}.{wm.lastCheck}.json")
-                return wm
+            with open(jsonPath, 'rb') as fp:
+                data = orjson.loads(fp.read()) if orjson is not None else json.load(fp)
+            wm = WorkshopManager.fromBuild(data)
+            shutil.copyfile(BUILD_JSON_PATH, f"{BUILD_JSON_PATH}.{wm.lastCheck}.json")
         else:
-            return WorkshopManager(None, None, [], { "algorithm": HASH_ALG, "segment": { "offset": 0, "length": 1024 } })
+            wm = WorkshopManager(None, None, [], None)
+        wm.savedCheck = wm.lastCheck
+        wm.journal = Journal(JOURNAL_PATH)
+        wm.replayJournal()
+        return wm
 
     def __init__(self, lastChecked, lastModified, maps, hashDetails):
         self.lastCheck = lastChecked
         self.lastModified = lastModified
         self.maps = { m.workshopId: WorkshopMap(**m) for m in maps }
-        #self.hashDetails = HashDetails(**hashDetails)
+        self.hashDetails = HashDetails(**hashDetails) if hashDetails is not None else None # Only set once segment hashes are generated
+        self.savedCheck = lastChecked
+        self.journal = None
+        self.changes = 0 # Map files added or Leth maps changed since this manager was loaded
+        self.lastFullSweep = None
+        self.retryIds = set() # Workshop maps whose details or download failed. They're checked through their page until they're up to date.
+
+    @staticmethod
+    def fromBuild(data):
+        if "py/object" in data:
+            data = WorkshopManager.migrateJsonpickle(data)
+        elif data.get("version") != WorkshopManager.SCHEMA_VERSION:
+            raise ValueError(f"Unsupported build json version {data.get('version')}")
+        wm = WorkshopManager(data["lastCheck"], data["lastModified"], [], data.get("hashDetails"))
+        wm.lastFullSweep = data.get("lastFullSweep")
+        wm.retryIds = set(data.get("retryIds", []))
+        for id, m in data["maps"].items():
+            wm.maps[id] = WorkshopMap.fromDict(m) if "mapFileHistory" in m else m
+        return wm
+
+    # Build jsons written before the schema are jsonpickle output: the manager's attributes, with "py/object" tags on the manager
+    # and each WorkshopMap. Dropping the tags leaves the schema's layout.
+    @staticmethod
+    def migrateJsonpickle(data):
+        print("Migrating build json from jsonpickle format")
+        maps = {}
+        for id, m in data["maps"].items():
+            if "py/id" in m:
+                raise ValueError(f"Can't migrate map {id}, it's a jsonpickle reference")
+            maps[id] = { k: v for k, v in m.items() if k != "py/object" }
+        return { "version": WorkshopManager.SCHEMA_VERSION, "lastCheck": data["lastCheck"], "lastModified": data["lastModified"], "maps": maps }
+
+    def toBuild(self, lastCheck=None):
+        build = {
+            "version": WorkshopManager.SCHEMA_VERSION,
+            "lastCheck": self.lastCheck if lastCheck is None else lastCheck,
+            "lastModified": self.lastModified,
+            "maps": { id: m.toDict() if isinstance(m, WorkshopMap) else m for id, m in self.maps.items() }
+        }
+        if self.hashDetails is not None:
+            build["hashDetails"] = { "algorithm": self.hashDetails.algorithm, "segment": self.hashDetails.segment }
+        if self.lastFullSweep is not None:
+            build["lastFullSweep"] = self.lastFullSweep
+        if len(self.retryIds) > 0:
+            build["retryIds"] = sorted(self.retryIds)
+        return build
+
+    # The maps.json clients download, byte for byte what jsonpickle.encode(workshopManager, unpicklable=False) used to give.
+    # With segment hashes, hashDetails tells clients which bytes to hash.
+    def toRelease(self):
+        release = {
+            "lastCheck": self.lastCheck,
+            "lastModified": self.lastModified,
+            "maps": { id: m.toDict() if isinstance(m, WorkshopMap) else m for id, m in self.maps.items() }
+        }
+        if self.hashDetails is not None:
+            release["hashDetails"] = { "algorithm": self.hashDetails.algorithm, "segment": self.hashDetails.segment }
+        return release
+
+    def replayJournal(self):
+        events = self.journal.read()
+        if len(events) == 0:
+            return
+        print(f"Resuming from {len(events)} journaled changes in {self.journal.path}")
+        for event in events:
+            if event["op"] == "mapFile":
+                m = event["map"]
+                if m["workshopId"] not in self.maps:
+                    self.maps[m["workshopId"]] = WorkshopMap(m["workshopId"], m["author"], m["title"], m["desc"], m["published"], [])
+                history = self.maps[m["workshopId"]].mapFileHistory
+                entry = MapFile.fromDict(event["entry"])
+                if entry not in history:
+                    history.append(entry)
+            elif event["op"] == "leth":
+                self.maps[event["details"]["title"]] = event["details"]
+            if event["lastModified"] is not None and (self.lastModified is None or event["lastModified"] > self.lastModified):
+                self.lastModified = event["lastModified"]
+        # Fold the replayed events into the snapshot now so the journal only ever holds this run's changes
+        self.compact()
+
+    def recordEvent(self, event):
+        if self.journal is None:
+            return
+        event["lastModified"] = self.lastModified
+        self.journal.append(event)
+        if self.journal.events >= JOURNAL_COMPACT_EVERY:
+            self.compact()
+
+    # Snapshots the catalog into the build json and starts a new journal. The snapshot keeps the lastCheck it was loaded with,
+    # as this run hasn't finished checking everything yet.
+    def compact(self):
+        self.save(BUILD_JSON_PATH, self.savedCheck)
+        self.journal.truncate()
+
+    def save(self, path, lastCheck=None):
+        build = self.toBuild(lastCheck)
+        data = orjson.dumps(build) if orjson is not None else json.dumps(build).encode('utf-8')
+        with open(path + ".tmp", 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + ".tmp", path)
+
+    # Builds the details dict for a map from GetPublishedFileDetails, if Steam says it hasn't been updated since the last check.
+    # The API's exact timestamps can't be compared with the minute precision, local time ones parsed from the workshop pages,
+    # so new and updated maps return None and go through the workshop page instead.
+    def detailsFromApi(self, workshopId, apiDetails, since):
+        # A map that failed last time can have an update from before since that we still don't have
+        if apiDetails is None or since is None or workshopId not in self.maps or workshopId in self.retryIds:
+            return None
+        if apiDetails["lastUpdated"] > since:
+            return None
+        m = self.maps[workshopId]
+        return { "title": m.title, "author": m.author, "desc": m.desc, "published": m.published, "lastUpdated": m.getLastUpdate() }
+
+    def needsFullSweep(self, previousCheck):
+        if "fullSweep" in sys.argv or previousCheck is None or self.lastFullSweep is None:
+            return True
+        return self.lastCheck - self.lastFullSweep >= FULL_SWEEP_INTERVAL
+
+    # Workshop ids to check this run. Unless it's time for a full sweep, the browse crawl stops at the first page of maps that are all
+    # known and were published before the last check. Maps on the pages it skipped are still checked, through the ids in the catalog
+    # and in retryIds. Yields the ids as they're found, each once.
+    def discoverWorkshopIDs(self, scraper, previousCheck):
+        if self.needsFullSweep(previousCheck):
+            print("Crawling every browse page")
+            if (yield from scraper.iterWorkshopIDs()):
+                self.lastFullSweep = self.lastCheck
+            return
+
+        def isKnown(id):
+            return id in MAPS_TO_SKIP or (id in self.maps and isinstance(self.maps[id], WorkshopMap) and self.maps[id].published < previousCheck)
+        crawled = set()
+        for id in scraper.iterWorkshopIDs(isKnown):
+            crawled.add(id)
+            yield id
+        for id, m in list(self.maps.items()):
+            if isinstance(m, WorkshopMap) and id not in crawled:
+                yield id
+        # A new map whose first download failed isn't in the catalog
+        for id in sorted(self.retryIds):
+            if id not in crawled and id not in self.maps:
+                yield id
 
     def mapHasUpdate(self, workshopId, lastUpdate):
         if workshopId not in self.maps:
@@ -534,85 +2222,220 @@ class WorkshopManager:
             return True
         return lastUpdateDownloaded < lastUpdate
 
-    def addMapData(self, workshopId, details, mapFile):
+    def addMapData(self, workshopId, details, mapFile, hashes=None):
         if workshopId not in self.maps:
             self.maps[workshopId] = WorkshopMap(workshopId, details["author"], details["title"], details["desc"], details["published"], [])
         updated = details["published"] if details["lastUpdated"] is None else details["lastUpdated"]
-        self.maps[workshopId].addMapFile(mapFile, updated)#, self.hashDetails)
+        m = self.maps[workshopId]
+        entry = m.addMapFile(mapFile, updated, hashes)#, self.hashDetails)
+        if entry is not None:
+            self.changes += 1
+            if self.hashDetails is not None:
+                entry.segmentHash = self.hashDetails.computeSegmentHash(mapFile)
+            self.recordEvent({ "op": "mapFile", "map": { "workshopId": m.workshopId, "author": m.author, "title": m.title, "desc": m.desc, "published": m.published }, "entry": entry.toDict() })
 
-    def addLethMapData(self, details):
-        details["fullHash"] = HashDetails.computeFullHash(os.path.join(WORKSHOP_PATH, clean_path(details["title"]), details["filename"]))
+    @staticmethod
+    def lethMapFilePath(details):
+        return os.path.join(WORKSHOP_PATH, clean_path(details["title"]), details["filename"])
+
+    def addLethMapData(self, details, hashes=None):
+        if hashes is None:
+            hashes = HashDetails.computeFileHashes(WorkshopManager.lethMapFilePath(details))
+        details["fullHash"] = hashes["fullHash"]
+        details["fastHash"] = hashes["fastHash"]
+        if self.hashDetails is not None:
+            details["segmentHash"] = self.hashDetails.computeSegmentHash(WorkshopManager.lethMapFilePath(details))
+        if self.maps.get(details["title"]) == details:
+            return
         self.maps[details["title"]] = details
+        self.changes += 1
+        self.recordEvent({ "op": "leth", "details": details })
 
     def getSmallestMapFileSize(self):
         smallest = -1
         for id, m in self.maps.items():
             for i, mapFile in enumerate(m.mapFileHistory):
-                mapFilePath = os.path.join(WORKSHOP_PATH, m.workshopId, str(mapFile["updateTimestamp"]), mapFile["filename"])
+                mapFilePath = os.path.join(WORKSHOP_PATH, m.workshopId, str(mapFile.updateTimestamp), mapFile.filename)
                 if i == len(m.mapFileHistory) - 1:
-                    mapFilePath = os.path.join(WORKSHOP_PATH, m.workshopId, mapFile["filename"])
+                    mapFilePath = os.path.join(WORKSHOP_PATH, m.workshopId, mapFile.filename)
                 if not os.path.exists(mapFilePath):
                     print("PATH DOESNT EXIST FOR " + mapFilePath)
-                    print("MAP FILE HISTORY: " + jsonpickle.encode(m.mapFileHistory))
+                    print("MAP FILE HISTORY: " + json.dumps([ f.toDict() for f in m.mapFileHistory ]))
                 s = os.path.getsize(mapFilePath)
                 if s == 0: print("File has size 0? " + mapFilePath)
                 if smallest > s or smallest < 0:
                     smallest = s
         return smallest
 
+    # Yields (entry, fpath) for every map file in the catalog: the MapFiles of the workshop maps and the Leth details dicts.
+    # Workshop versions are read from the blob store when they're in it.
+    def mapFiles(self, blobStore):
+        for id, m in self.maps.items():
+            if isinstance(m, WorkshopMap):
+                for mapFile in m.mapFileHistory:
+                    fpath = blobStore.blobPath(mapFile.fullHash) if blobStore.has(mapFile.fullHash) else mapFilePath(m, mapFile)
+                    yield mapFile, fpath
+            else:
+                yield m, WorkshopManager.lethMapFilePath(m)
+
+    # Files with the same content share a segment hash, every other pair of files must have different ones
     def allSegmentHashesUnique(self):
-        segmentHashes = set()
+        contentBySegment = {}
         for id, m in self.maps.items():
-            thisMapsSegments = []
-            for mapFile in m.mapFileHistory:
-                if mapFile["segmentHash"] in segmentHashes:
+            entries = m.mapFileHistory if isinstance(m, WorkshopMap) else [ m ]
+            for entry in entries:
+                fullHash, segmentHash = (entry.fullHash, entry.segmentHash) if isinstance(entry, MapFile) else (entry["fullHash"], entry.get("segmentHash"))
+                if segmentHash is None:
+                    return False
+                if contentBySegment.setdefault(segmentHash, fullHash) != fullHash:
                     return False
-                thisMapsSegments.append(mapFile["segmentHash"])
-            for s in thisMapsSegments:
-                segmentHashes.add(s)
         return True
 
-    '''def generateUniqueSegmentHashes(self):
-        # This function defunc'd and filled with debug prints and other shit. We no longer care about unique hashes.
-        if self.allSegmentHashesUnique():
-            return
-        smallestFile = self.getSmallestMapFileSize()
-        skipThisOffset = False
-        for m in range(0, int((smallestFile - 1024) / 256)):
-            segLen = 1024 + 256*m
-            self.hashDetails.segment["length"] = segLen
-            for i in range(0, int(smallestFile / segLen)):
-                if m == 0 and i == 0: continue
-                self.hashDetails.segment["offset"] = segLen * i
-                segmentHashes = set()
-                skipThisOffset = False # Used to double break outside of offset loop
-                for id, m in self.maps.items():
-                    thisMapsSegments = []
-                    for mapFile in m.mapFileHistory:
-                        fp = mapFilePath(m, mapFile)
-                        if fp is None:
-                            print(f"FAILED TO FIND FILEPATH FOR -> {id}")
-                            sys.exit()
-                        segHash = self.hashDetails.computeSegmentHash(fp)
-                        if segHash in segmentHashes:
-                            skipThisOffset = True
-                            break
-                        else:
-                            thisMapsSegments.append(segHash)
-                            mapFile["segmentHash"] = segHash
-                    if skipThisOffset:
-                        break
-                    for s in thisMapsSegments:
-                        segmentHashes.add(s)
-        if skipThisOffset or not self.allSegmentHashesUnique():
-            with open('build/non-unique-hashes.json', 'w') as fp:
-                fp.write(jsonpickle.encode(self))
+    # Picks the segment that identifies every map file by hashing a few KB of it and stores each file's segment hash next to
+    # its fullHash. Each distinct file is looked at once, however many versions or maps share it.
+    def generateUniqueSegmentHashes(self, blobStore):
+        paths = {}
+        for entry, fpath in self.mapFiles(blobStore):
+            fullHash = entry.fullHash if isinstance(entry, MapFile) else entry["fullHash"]
+            if fpath is None or not os.path.exists(fpath):
+                print(f"FAILED TO FIND FILEPATH FOR -> {fullHash}, it won't get a segment hash")
+                continue
+            paths.setdefault(fullHash, fpath)
+
+        with METRICS.stage("segmentSearch"):
+            segment = HashDetails.findUniqueSegment(list(paths.values()))
+        if segment is None:
             print(f"FAILED TO FIND UNIQUE HASH SEGMENT")
-            sys.exit()
-    '''
+            return False
+        print(f"Segment hashing {len(paths)} map files at offset {segment['offset']}, length {segment['length']}")
+        self.hashDetails = HashDetails(HASH_ALG, segment)
+
+        segmentHashes = { fullHash: self.hashDetails.computeSegmentHash(fpath) for fullHash, fpath in paths.items() }
+        for entry, fpath in self.mapFiles(blobStore):
+            if isinstance(entry, MapFile):
+                entry.segmentHash = segmentHashes.get(entry.fullHash)
+            elif entry["fullHash"] in segmentHashes:
+                entry["segmentHash"] = segmentHashes[entry["fullHash"]]
+        return self.allSegmentHashesUnique()
+
+
+# Writes data to path along with gzip (and brotli, if available) compressed copies for clients that accept them
+def writeReleaseFile(path, data):
+    raw = data.encode('utf-8')
+    with open(path, 'wb') as fp:
+        fp.write(raw)
+    # mtime=0 keeps the .gz byte identical when the content doesn't change, so git doesn't see a new file every run
+    with open(path + ".gz", 'wb') as fp:
+        fp.write(gzip.compress(raw, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + ".br", 'wb') as fp:
+            fp.write(brotli.compress(raw))
+    elif os.path.exists(path + ".br"):
+        os.remove(path + ".br")
+
+def removeReleaseFile(path):
+    for p in [ path, path + ".gz", path + ".br" ]:
+        if os.path.exists(p):
+            os.remove(p)
+
+# Writes the release json and meta, plus delta files holding the maps added or changed since each of the last MAX_DELTAS releases.
+# A client on release <lastModified> listed in meta.json's "deltas" can fetch deltas/maps.<lastModified>.json instead of everything.
+def publishRelease(workshopManager):
+    releaseData = workshopManager.toRelease()
+    release = json.dumps(releaseData)
+    maps = releaseData["maps"]
+
+    previous = None
+    if os.path.exists(RELEASE_JSON_PATH):
+        with open(RELEASE_JSON_PATH, 'r') as fp:
+            previous = json.load(fp)
+
+    history = []
+    if os.path.exists(DELTA_HISTORY_PATH):
+        with open(DELTA_HISTORY_PATH, 'r') as fp:
+            history = [ entry for entry in json.load(fp) if entry["base"] is not None ]
+
+    changed = []
+    removed = []
+    base = None
+    if previous is not None:
+        changed = [ id for id, m in maps.items() if previous["maps"].get(id) != m ]
+        removed = [ id for id in previous["maps"] if id not in maps ]
+        base = previous["lastModified"]
+
+    # Leth map changes don't touch lastModified on their own, and clients only look at meta.json. A release with maps in it always
+    # gets a lastModified, even if no workshop map was downloaded (e.g. a first run with skipSteam).
+    if len(changed) > 0 or len(removed) > 0 or (workshopManager.lastModified is None and len(maps) > 0):
+        if workshopManager.lastModified is None or (base is not None and workshopManager.lastModified <= base):
+            workshopManager.lastModified = workshopManager.lastCheck
+            releaseData["lastModified"] = workshopManager.lastModified
+            release = json.dumps(releaseData)
+    # A release without a lastModified can't be named as a delta's base
+    if base is not None and (len(changed) > 0 or len(removed) > 0):
+        history.append({ "base": base, "lastModified": workshopManager.lastModified, "changed": changed, "removed": removed })
+        history = history[-MAX_DELTAS:]
+
+    if not os.path.exists(RELEASE_DELTAS_PATH):
+        os.makedirs(RELEASE_DELTAS_PATH)
+    deltaBases = []
+    for i, entry in enumerate(history):
+        changedIds = set()
+        removedIds = set()
+        for later in history[i:]:
+            changedIds.update(later["changed"])
+            removedIds.update(later["removed"])
+        delta = {
+            "base": entry["base"],
+            "lastModified": workshopManager.lastModified,
+            "maps": { id: m for id, m in maps.items() if id in changedIds },
+            "removed": sorted(id for id in removedIds if id not in maps)
+        }
+        writeReleaseFile(os.path.join(RELEASE_DELTAS_PATH, f"maps.{entry['base']}.json"), json.dumps(delta))
+        deltaBases.append(entry["base"])
+
+    for f in os.listdir(RELEASE_DELTAS_PATH):
+        base = f.split('.')[1] if f.startswith("maps.") else None
+        if base is not None and base.isdigit() and int(base) not in deltaBases:
+            removeReleaseFile(os.path.join(RELEASE_DELTAS_PATH, f))
+
+    with open(DELTA_HISTORY_PATH, 'w') as fp:
+        json.dump(history, fp)
+
+    writeReleaseFile(RELEASE_JSON_PATH, release)
+    maplookup.writeIndex(maps, RELEASE_INDEX_PATH)
+    # meta.json goes last since clients poll it to decide what to fetch
+    with open(RELEASE_META_JSON_PATH, 'w') as fp:
+        json.dump({
+            "lastCheck": workshopManager.lastCheck,
+            "lastModified": workshopManager.lastModified,
+            "deltas": deltaBases
+        }, fp)
 
 
-def main(successScript):
+# Yields (id, details) for ids in order. Unless useApi is False, details come from batched GetPublishedFileDetails requests, and only
+# maps that are new or changed since `since` have their workshop page fetched. A batch is sent early when ids stop coming, so maps
+# found by a crawl are resolved while it reads the next page.
+def resolveWorkshopDetails(scraper, workshopManager, ids, since, useApi=True):
+    if not useApi:
+        yield from scraper.getWorkshopDetailsMany(ids)
+        return
+    for batch in batched(ids, STEAM_API_BATCH_SIZE, STEAM_API_BATCH_WAIT):
+        apiDetails = scraper.getPublishedFileDetails(batch)
+        resolved = { id: workshopManager.detailsFromApi(id, apiDetails.get(id), since) for id in batch }
+        fallback = [ id for id in batch if resolved[id] is None ]
+        METRICS.count("apiResolved", len(batch) - len(fallback))
+        METRICS.count("apiFallback", len(fallback))
+        # The ones Steam says changed mustn't use a page cached before the change
+        resolved.update(scraper.getWorkshopDetailsMany([ id for id in fallback if id not in apiDetails ]))
+        resolved.update(scraper.getWorkshopDetailsMany([ id for id in fallback if id in apiDetails ], revalidate=True))
+        for id in batch:
+            yield id, resolved[id]
+
+
+# Command line flags. Any other argument is the success script.
+FLAGS = set([ "skipSteam", "skipLeth", "skipSteamApi", "useSelenium", "fullLeth", "forceRehash", "segmentHashes", "compareExtractors", "gcBlobs", "watch", "fullSweep" ])
+
+def printNotes():
     print("\n\nTHIS SCRIPT ISN'T VERY USER FRIENDLY AND I WOULDN'T CONSIDER IT A \"RELEASE\" VERSION.")
     print("PLEASE READ IF THIS IS YOUR FIRST TIME RUNNING THIS.")
     print("When using DepotDownloader for the first time with a steam account, you will likely need to provide an authentication code.")
@@ -622,73 +2445,134 @@ def main(successScript):
     print("\n\n")
     sys.stdout.flush()
 
-    scraper = Scraper(PageCache())
-    workshopManager = WorkshopManager.fromJson(BUILD_JSON_PATH)
-    workshopManager.lastCheck = int(datetime.datetime.now().timestamp())
-    
-    ids = []
-    if "skipSteam" not in sys.argv:
-        ids = scraper.getWorkshopIDs()
-
-        print(f"Processing {len(ids)} maps")
-
+# Returns a Future for fn(id, download), which is submitted to executor once download is done so no thread waits on it
+def whenDownloaded(executor, fn, id, download):
+    finished = Future()
+    def copyResult(future):
+        if future.exception() is not None:
+            finished.set_exception(future.exception())
+        else:
+            finished.set_result(future.result())
+    download.add_done_callback(lambda download: executor.submit(fn, id, download).add_done_callback(copyResult))
+    return finished
+
+# Brings the workshop maps in ids up to date: fetches their details, downloads the new and updated ones and adds them to the manager.
+# ids can be a stream that's still being crawled, each map's details are fetched and its download queued as soon as it comes in.
+# Returns every id seen.
+def syncWorkshopMaps(scraper, workshopManager, hashCache, blobStore, ids, since):
+    seen = []
+    def record(ids):
         for id in ids:
-            if id in MAPS_TO_SKIP:
-                continue
+            seen.append(id)
+            if id not in MAPS_TO_SKIP:
+                yield id
 
-            # Get details
-            sys.stdout.flush()
-            details = scraper.getWorkshopDetails(id)
-            if details is None:
+    # Hashes a map once it's downloaded, on one of the finisher threads so hashing overlaps the other downloads
+    def finishDownload(id, download):
+        mapFile = download.result()
+        if mapFile is None:
+            mapFile = scraper.getWorkshopMapFileFromSteamFolder(id)
+            if mapFile is None:
+                return None, None
+        return mapFile, HashDetails.computeFileHashesMany([ mapFile ], hashCache)[mapFile]
+
+    # Adds the finished maps to the manager, and so the journal, in the order they were queued so the merges are deterministic.
+    # Only the ones that finish ahead of a map still downloading wait.
+    queued = deque()
+    def merge(block):
+        while len(queued) > 0 and (block or queued[0][2].done()):
+            id, details, finished = queued.popleft()
+            workshopManager.lastModified = workshopManager.lastCheck
+            try:
+                mapFile, hashes = finished.result()
+            except Exception as e:
+                print(f"FAILED TO GET MAP FILE FOR -> {id}. Error: {e}")
+                mapFile = None
+            if mapFile is None:
+                workshopManager.retryIds.add(id)
                 continue
-
-            # Get workshop map file
-            hasUpdate = workshopManager.mapHasUpdate(id, details["lastUpdated"])
-            if hasUpdate:
-                workshopManager.lastModified = workshopManager.lastCheck
-                mapFile = scraper.getWorkshopMapFile(id, hasUpdate)
-                if mapFile is None:
-                    mapFile = scraper.getWorkshopMapFileFromSteamFolder(id)
-                    if mapFile is None:
-                        continue
-                
-                # Add data to workshop manager
-                workshopManager.addMapData(id, details, mapFile)
-
-    lethMapLinks = []
-    if "skipLeth" not in sys.argv:
-        # TODO: Some maps have more than one download (spaceship)
-        lethMapLinks = scraper.getLethMaps()
-
-        print(f"Processing {len(lethMapLinks)} leth maps")
-
-        for link in lethMapLinks:
+            workshopManager.retryIds.discard(id)
+            blobStore.add(mapFile, hashes["fullHash"])
+            workshopManager.addMapData(id, details, mapFile, hashes)
+            workshopManager.maps[id].linkHistory(blobStore)
+
+    # Get details. These are fetched concurrently and come back in the order the ids did
+    downloads = 0
+    with ThreadPoolExecutor(max_workers=max(1, HASH_WORKERS)) as finishers:
+        for id, details in resolveWorkshopDetails(scraper, workshopManager, record(ids), since, "skipSteamApi" not in sys.argv):
             sys.stdout.flush()
-            details = scraper.getLethMapDetails(link)
+            merge(False)
             if details is None:
+                workshopManager.retryIds.add(id)
                 continue
-
-            details = scraper.getLethMapFile(details)
-            if details is None:
+            if not workshopManager.mapHasUpdate(id, details["lastUpdated"]):
+                workshopManager.retryIds.discard(id)
                 continue
+            # Put the version we have into the blob store before DepotDownloader overwrites it
+            if id in workshopManager.maps:
+                workshopManager.maps[id].backupExistingFiles(blobStore, hashCache)
+            # Downloads run in parallel across steam accounts
+            queued.append((id, details, whenDownloaded(finishers, finishDownload, id, scraper.downloadWorkshopMapFile(id))))
+            downloads += 1
+
+        print(f"Checked {len(seen)} maps, downloading {downloads} updated maps")
+        merge(True)
+    return seen
+
+# Crawls Lethamyr's maps and adds the new and changed ones to the manager. Returns every map link found.
+# Posts are fetched and downloaded while the listing pages are still being crawled.
+def syncLethMaps(scraper, workshopManager, hashCache, since):
+    # TODO: Some maps have more than one download (spaceship)
+    lethMapLinks = []
+    def record(links):
+        for link in links:
+            lethMapLinks.append(link)
+            yield link
+
+    knownLinks = set(m["link"] for m in workshopManager.maps.values() if isinstance(m, dict) and "link" in m)
+    lethUpdates = scraper.lethLinksToUpdate(record(streamInBackground(scraper.iterLethMaps(), "lethCrawl")), knownLinks, since)
+    lethDetails = ( details for link, details in scraper.getLethMapDetailsMany(lethUpdates) if details is not None )
+
+    # The .udk is usually hashed while it's extracted, so this is mostly a hash cache hit
+    def downloadLethMap(details):
+        with METRICS.stage("lethDownload"):
+            details = scraper.getLethMapFile(details, hashCache)
+        if details is None:
+            return None, None
+        mapFile = WorkshopManager.lethMapFilePath(details)
+        return details, HashDetails.computeFileHashesMany([ mapFile ], hashCache)[mapFile]
+
+    # Downloads run LETH_DOWNLOAD_CONCURRENCY at a time and come back in the order the crawl found them, each one is added
+    # to the manager, and so the journal, as soon as it's ready
+    processed = 0
+    for details, hashes in boundedMap(downloadLethMap, lethDetails, LETH_DOWNLOAD_CONCURRENCY):
+        sys.stdout.flush()
+        if details is None:
+            continue
 
-            del details["download"]
-            workshopManager.addLethMapData(details)
+        del details["download"]
+        workshopManager.addLethMapData(details, hashes)
+        processed += 1
 
-    # Find segments in map files that produce a unique hash
-    #workshopManager.generateUniqueSegmentHashes()
-
-    # Save results
-    with open(BUILD_JSON_PATH, 'w') as fp:
-        fp.write(jsonpickle.encode(workshopManager))
-    with open(RELEASE_JSON_PATH, 'w') as fp:
-        fp.write(jsonpickle.encode(workshopManager, unpicklable=False))
-    with open(RELEASE_META_JSON_PATH, 'w') as fp:
-        json.dump({
-            "lastCheck": workshopManager.lastCheck,
-            "lastModified": workshopManager.lastModified
-        }, fp)
+    print(f"Processed {processed} of {len(lethMapLinks)} leth maps, the rest haven't changed")
+    return lethMapLinks
 
+def saveResults(workshopManager, blobStore, hashCache):
+    # Find segments in map files that produce a unique hash
+    if "segmentHashes" in sys.argv:
+        if not workshopManager.generateUniqueSegmentHashes(blobStore):
+            print("Some map files don't have a unique segment hash")
+
+    with METRICS.stage("jsonWrite"):
+        publishRelease(workshopManager)
+        workshopManager.save(BUILD_JSON_PATH)
+        workshopManager.journal.truncate()
+        hashCache.save()
+    # What's been published is checked, later snapshots (a watch's next poll compacting its journal) can say so
+    workshopManager.savedCheck = workshopManager.lastCheck
+    METRICS.count("maps", len(workshopManager.maps))
+
+def reportMissing(workshopManager, ids, lethMapLinks):
     workshopIds = set(ids)
     lethMapLinksSet = set(lethMapLinks)
     for id in workshopManager.maps:
@@ -703,14 +2587,94 @@ def main(successScript):
     print("Workshop IDs missing from maps.json: \n\t" + "\n\t".join(list(workshopIds)))
     print("\n\nLeth maps missing from maps.json: \n\t" + "\n\t".join(list(lethMapLinksSet)))
 
+def main(successScript):
+    printNotes()
+
+    atexit.register(METRICS.write)
+    scraper = Scraper(PageCache(), useSelenium="useSelenium" in sys.argv)
+    hashCache = HashCache(HASH_CACHE_PATH, forceRehash="forceRehash" in sys.argv)
+    blobStore = BlobStore(BLOB_STORE_PATH)
+    workshopManager = WorkshopManager.fromJson(BUILD_JSON_PATH)
+    previousCheck = workshopManager.lastCheck
+    workshopManager.lastCheck = int(datetime.datetime.now().timestamp())
+    
+    ids = []
+    if "skipSteam" not in sys.argv:
+        # Discovery runs in the background, maps are processed as it finds them
+        discovered = streamInBackground(workshopManager.discoverWorkshopIDs(scraper, previousCheck), "workshopCrawl")
+        ids = syncWorkshopMaps(scraper, workshopManager, hashCache, blobStore, discovered, previousCheck)
+
+    lethMapLinks = []
+    if "skipLeth" not in sys.argv:
+        lethMapLinks = syncLethMaps(scraper, workshopManager, hashCache, previousCheck)
+
+    scraper.downloader.shutdown()
+
+    # Save results
+    saveResults(workshopManager, blobStore, hashCache)
+    reportMissing(workshopManager, ids, lethMapLinks)
+
     print("\n\nScript finished. You can find the final json file in: " + RELEASE_JSON_PATH + "\n\n")
 
     if (successScript):
         os.system(successScript)
+
+# Keeps the scraper, browsers and catalog loaded and polls the first page of the most recent and last updated workshop maps every
+# WATCH_INTERVAL seconds (and Lethamyr, unless skipLeth). Releases are only published, and successScript only run, when a poll
+# changed something.
+def watch(successScript):
+    printNotes()
+
+    scraper = Scraper(PageCache(), useSelenium="useSelenium" in sys.argv)
+    hashCache = HashCache(HASH_CACHE_PATH, forceRehash="forceRehash" in sys.argv)
+    blobStore = BlobStore(BLOB_STORE_PATH)
+    workshopManager = WorkshopManager.fromJson(BUILD_JSON_PATH)
+
+    print(f"Watching for new maps every {WATCH_INTERVAL} seconds")
+    published = workshopManager.changes
+    try:
+        while True:
+            pollStart = time.time()
+            METRICS.reset()
+            since = workshopManager.lastCheck
+            workshopManager.lastCheck = int(datetime.datetime.now().timestamp())
+            scraper.fetcher.resetErrorBudget()
+            scraper.setTimezoneCookie() # In case daylight saving time started or ended since the last poll
+            try:
+                if "skipSteam" not in sys.argv:
+                    ids = scraper.getRecentWorkshopIDs([ MOST_RECENT_URL, LAST_UPDATED_URL ])
+                    ids += [ id for id in sorted(workshopManager.retryIds) if id not in ids ]
+                    syncWorkshopMaps(scraper, workshopManager, hashCache, blobStore, ids, since)
+                if "skipLeth" not in sys.argv:
+                    syncLethMaps(scraper, workshopManager, hashCache, since)
+
+                changes = workshopManager.changes - published
+                if changes > 0:
+                    print(f"{changes} map files changed, publishing")
+                    saveResults(workshopManager, blobStore, hashCache)
+                    published = workshopManager.changes
+                    if (successScript):
+                        os.system(successScript)
+            except Exception as e:
+                # Keep watching, anything this poll missed is picked up by the next one as it checks since the same time
+                workshopManager.lastCheck = since
+                print(f"Poll failed: {e}")
+            METRICS.write()
+            sys.stdout.flush()
+            time.sleep(max(0, WATCH_INTERVAL - (time.time() - pollStart)))
+    finally:
+        scraper.downloader.shutdown()
     
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        main(sys.argv[1])
+    if "compareExtractors" in sys.argv:
+        sys.exit(0 if compareExtractors() else 1)
+    if "gcBlobs" in sys.argv:
+        removed, freed = BlobStore(BLOB_STORE_PATH).gc()
+        print(f"Removed {removed} unreferenced map files from {BLOB_STORE_PATH}, freeing {freed / 1024 / 1024:.1f} MB")
+        sys.exit(0)
+    successScript = next((arg for arg in sys.argv[1:] if arg not in FLAGS), None)
+    if "watch" in sys.argv:
+        watch(successScript)
     else:
-        main(None)
\ No newline at end of file
+        main(successScript)
@@ -0,0 +1,49 @@
+import os
+import sys
+import json
+import tempfile
+
+# scraper reads its settings when it's imported, so every test module imports it from here. Everything it might write goes to
+# a scratch directory, and Steam is benchmark.py's stand-in server, which serves the workshop pages in fixtures/workshop and
+# answers GetPublishedFileDetails from the response recorded in fixtures/api.
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+WORK_DIR = tempfile.mkdtemp(prefix="rlws-test-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+def loadPages():
+    pages = {}
+    for name in sorted(os.listdir(os.path.join(FIXTURES_PATH, "workshop"))):
+        with open(os.path.join(FIXTURES_PATH, "workshop", name), 'rb') as fp:
+            pages[name[:-len(".html")]] = fp.read()
+    return pages
+
+def loadApiDetails():
+    with open(os.path.join(FIXTURES_PATH, "api", "GetPublishedFileDetails.json"), 'r', encoding='utf-8') as fp:
+        files = json.load(fp)["response"]["publishedfiledetails"]
+    return { f["publishedfileid"]: f for f in files }
+
+PAGES = loadPages()
+SERVER, SERVER_STATS = benchmark.startServer(PAGES, loadApiDetails())
+STEAM_URL = f"http://127.0.0.1:{SERVER.server_address[1]}"
+
+os.environ.update({
+    "BUILD_JSON_PATH": os.path.join(WORK_DIR, "build", "maps.json"),
+    "RELEASE_JSON_PATH": os.path.join(WORK_DIR, "releases", "maps.json"),
+    "RELEASE_META_JSON_PATH": os.path.join(WORK_DIR, "releases", "meta.json"),
+    "HASH_CACHE_PATH": os.path.join(WORK_DIR, "build", "hashcache.json"),
+    "WORKSHOP_PATH": os.path.join(WORK_DIR, "workshop"),
+    "STEAM_WORKSHOP_PATH": os.path.join(WORK_DIR, "steam-workshop"),
+    "PAGE_CACHE_PATH": os.path.join(WORK_DIR, "cache"),
+    "STEAM_ACCOUNTS": json.dumps([]),
+    "STEAM_COMMUNITY_URL": STEAM_URL,
+    "STEAM_API_URL": STEAM_URL,
+    "DEPOT_DOWNLOADER": "DepotDownloader.dll",
+    "CHROME_DRIVER": "none",
+    # The stand-in never pushes back, so don't wait on the per-host throttle
+    "FETCH_RATE": "1000",
+    "FETCH_MAX_RATE": "1000"
+})
+
+import scraper
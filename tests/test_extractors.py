@@ -0,0 +1,49 @@
+import os
+import unittest
+
+from support import scraper, FIXTURES_PATH
+
+
+# Workshop pages, named <id>.html, and browse pages run through both extractors. 2000000201 and up and the browse pages have the
+# full markup of Steam's pages: header, scripts, BBCode descriptions, comments and the pager. The others cover the whitespace
+# BeautifulSoup collapses: whitespace only strings between tags, inside and outside <pre>/<textarea>, around comments and
+# scripts, and \r\n pages.
+class ExtractorTest(unittest.TestCase):
+
+    def pages(self, kind="workshop"):
+        for name in sorted(os.listdir(os.path.join(FIXTURES_PATH, kind))):
+            with open(os.path.join(FIXTURES_PATH, kind, name), 'rb') as fp:
+                yield name[:-len(".html")], fp.read().decode('utf-8')
+
+    def test_extractors_agree(self):
+        for id, pageSource in self.pages():
+            with self.subTest(id=id):
+                details = scraper.extractWorkshopDetails(id, pageSource)
+                self.assertIsNotNone(details)
+                self.assertEqual(details, scraper.extractWorkshopDetailsSoup(id, pageSource))
+
+    def test_browse_extractors_agree(self):
+        for name, pageSource in self.pages("browse"):
+            for source in [ pageSource, pageSource.replace('\n', '\r\n') ]:
+                with self.subTest(page=name, crlf='\r' in source):
+                    ids, url = scraper.extractBrowsePage(source)
+                    self.assertGreater(len(ids), 0)
+                    self.assertEqual((ids, url), scraper.extractBrowsePageSoup(source))
+
+    def test_browse_pager(self):
+        pages = dict(self.pages("browse"))
+        for name, next in [ ("mostrecent-1", "2"), ("mostrecent-2", "3"), ("mostrecent-3", None) ]:
+            with self.subTest(page=name):
+                ids, url = scraper.extractBrowsePage(pages[name])
+                if next is None:
+                    self.assertIsNone(url)
+                else:
+                    self.assertEqual(url, scraper.STEAM_COMMUNITY_URL + "/workshop/browse/?appid=252950&browsesort=mostrecent&section=readytouseitems&actualsort=mostrecent&p=" + next)
+
+    def test_whitespace_between_tags(self):
+        pageSource = dict(self.pages())["2000000101"]
+        self.assertEqual(scraper.extractWorkshopDetails("2000000101", pageSource)["desc"], "a\n \nb")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from support import scraper, SERVER_STATS, WORK_DIR
+
+WORKSHOP_ID = "2000000201"
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(dir=WORK_DIR)
+        patcher = mock.patch.object(scraper, "PAGE_CACHE_PATH", os.path.join(self.workDir, "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        scraper.METRICS.reset()
+        self.scraper = scraper.Scraper(scraper.PageCache())
+        self.addCleanup(self.scraper.downloader.shutdown)
+
+    def counter(self, name):
+        return scraper.METRICS.report()["counters"].get(name, 0)
+
+    def expire(self, key):
+        with self.scraper.pageCache.lock:
+            self.scraper.pageCache.db.execute("UPDATE pages SET expiresAt = 0 WHERE key = ?", (key,))
+            self.scraper.pageCache.db.commit()
+
+    def test_not_modified_page_is_refreshed_without_parsing(self):
+        key = scraper.PageCache.workshopKey(WORKSHOP_ID)
+        details = self.scraper.getWorkshopDetails(WORKSHOP_ID)
+        self.assertIsNotNone(self.scraper.pageCache.lookup(key)["etag"])
+        self.expire(key)
+        self.assertFalse(self.scraper.pageCache.lookup(key)["fresh"])
+
+        notModified = SERVER_STATS["notModified"]
+        pageCache = self.scraper.pageCache
+        with mock.patch.object(pageCache, "refresh", wraps=pageCache.refresh) as refresh, \
+                mock.patch.object(scraper, "extractWorkshopDetails", wraps=scraper.extractWorkshopDetails) as extract:
+            self.assertEqual(self.scraper.getWorkshopDetails(WORKSHOP_ID), details)
+        refresh.assert_called_once_with(key)
+        extract.assert_not_called()
+        self.assertEqual(SERVER_STATS["notModified"], notModified + 1)
+        self.assertEqual(self.counter("pageNotModified"), 1)
+        self.assertEqual(self.counter("parsedCacheHit"), 1)
+        self.assertTrue(pageCache.lookup(key)["fresh"])
+
+    def test_refetched_page_reuses_its_parsed_details(self):
+        key = scraper.PageCache.workshopKey(WORKSHOP_ID)
+        self.scraper.getWorkshopDetails(WORKSHOP_ID)
+        with self.scraper.pageCache.lock:
+            self.scraper.pageCache.db.execute("UPDATE pages SET etag = NULL WHERE key = ?", (key,))
+            self.scraper.pageCache.db.commit()
+        self.expire(key)
+
+        with mock.patch.object(scraper, "extractWorkshopDetails", wraps=scraper.extractWorkshopDetails) as extract:
+            self.scraper.getWorkshopDetails(WORKSHOP_ID)
+        # Without an ETag the whole page comes back, but it's the same content, so the details parsed before still apply
+        self.assertEqual(self.counter("pageNotModified"), 0)
+        extract.assert_not_called()
+        self.assertEqual(self.counter("parsedCacheHit"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
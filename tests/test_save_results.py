@@ -0,0 +1,35 @@
+import os
+import json
+import tempfile
+import unittest
+
+from support import scraper, WORK_DIR
+
+
+class SaveResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(dir=WORK_DIR)
+        for path in [ scraper.BUILD_JSON_PATH, scraper.RELEASE_JSON_PATH ]:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def readBuild(self):
+        with open(scraper.BUILD_JSON_PATH, 'rb') as fp:
+            return json.load(fp)
+
+    # A watch keeps one manager across polls. A journal compaction after a publish must not take the catalog back to the check
+    # the manager was loaded with.
+    def test_publish_moves_the_snapshot_check_forward(self):
+        scraper.WorkshopManager(1500000000, 1500000000, [], None).save(scraper.BUILD_JSON_PATH)
+        manager = scraper.WorkshopManager.fromJson(scraper.BUILD_JSON_PATH)
+        manager.lastCheck = 1600000000
+        scraper.saveResults(manager, scraper.BlobStore(os.path.join(self.workDir, "blobs")), scraper.HashCache(os.path.join(self.workDir, "hashcache.json")))
+        self.assertEqual(self.readBuild()["lastCheck"], 1600000000)
+
+        manager.lastCheck = 1700000000
+        manager.compact()
+        self.assertEqual(self.readBuild()["lastCheck"], 1600000000)
+
+
+if __name__ == "__main__":
+    unittest.main()
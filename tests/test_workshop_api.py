@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+from support import scraper, PAGES, SERVER_STATS, WORK_DIR
+
+SINCE = 1600000000 # Between the recorded time_updated of the maps that haven't changed and of 2000000201, which has
+
+def catalogMap(id):
+    return { "workshopId": id, "author": "Catalog author", "title": "Catalog title", "desc": "Catalog description", "published": 1500000000,
+        "mapFileHistory": [ { "filename": "map.udk", "fullHash": "0" * 32, "updateTimestamp": 1500000000 } ] }
+
+
+# resolveWorkshopDetails against the recorded GetPublishedFileDetails response: 2000000101 and 2000000102 haven't changed since
+# SINCE, 2000000201 has and Steam doesn't know 2000000202.
+class WorkshopApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(dir=WORK_DIR)
+        patcher = mock.patch.object(scraper, "PAGE_CACHE_PATH", os.path.join(self.workDir, "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        scraper.METRICS.reset()
+        self.scraper = scraper.Scraper(scraper.PageCache())
+        self.addCleanup(self.scraper.downloader.shutdown)
+        self.manager = scraper.WorkshopManager.fromBuild({ "version": 1, "lastCheck": SINCE, "lastModified": SINCE,
+            "maps": { id: catalogMap(id) for id in [ "2000000101", "2000000102", "2000000201" ] } })
+
+    def resolve(self, id, since=SINCE):
+        return dict(scraper.resolveWorkshopDetails(self.scraper, self.manager, [ id ], since))[id]
+
+    def pageDetails(self, id):
+        return scraper.extractWorkshopDetails(id, PAGES[id].decode('utf-8'))
+
+    def counter(self, name):
+        return scraper.METRICS.report()["counters"].get(name, 0)
+
+    def test_unchanged_map_comes_from_the_catalog(self):
+        requests = SERVER_STATS["requests"]
+        details = self.resolve("2000000101")
+        self.assertEqual(details, { "title": "Catalog title", "author": "Catalog author", "desc": "Catalog description", "published": 1500000000, "lastUpdated": 1500000000 })
+        self.assertEqual(self.counter("apiResolved"), 1)
+        self.assertEqual(SERVER_STATS["requests"], requests)
+
+    def test_unknown_map_falls_back_to_its_page(self):
+        requests = SERVER_STATS["requests"]
+        self.assertEqual(self.resolve("2000000202"), self.pageDetails("2000000202"))
+        self.assertEqual(self.counter("apiFallback"), 1)
+        self.assertEqual(SERVER_STATS["requests"], requests + 1)
+
+    def test_updated_map_revalidates_its_cached_page(self):
+        self.scraper.getWorkshopDetails("2000000201")
+        requests = SERVER_STATS["requests"]
+        # The cached page hasn't expired, but it may be from before the update
+        self.assertEqual(self.resolve("2000000201"), self.pageDetails("2000000201"))
+        self.assertEqual(self.counter("apiFallback"), 1)
+        self.assertEqual(SERVER_STATS["requests"], requests + 1)
+
+    def test_failed_download_is_retried(self):
+        failed = Future()
+        failed.set_result(None)
+        with mock.patch.object(self.scraper, "downloadWorkshopMapFile", return_value=failed):
+            scraper.syncWorkshopMaps(self.scraper, self.manager, scraper.HashCache(os.path.join(self.workDir, "hashcache.json")),
+                scraper.BlobStore(os.path.join(self.workDir, "blobs")), [ "2000000201" ], SINCE)
+        self.assertEqual(self.manager.retryIds, { "2000000201" })
+        self.assertEqual(scraper.WorkshopManager.fromBuild(self.manager.toBuild()).retryIds, { "2000000201" })
+
+        # The next run checks for changes since after the update, which the catalog still doesn't have
+        details = self.resolve("2000000201", since=1700000000)
+        self.assertEqual(details, self.pageDetails("2000000201"))
+        self.assertTrue(self.manager.mapHasUpdate("2000000201", details["lastUpdated"]))
+
+    def test_failed_new_map_is_discovered_again(self):
+        # 2000000202 is on the browse pages, 2000009999 has dropped off them. Neither made it into the catalog.
+        self.manager.retryIds = { "2000000202", "2000009999" }
+        self.manager.lastFullSweep = SINCE
+        ids = list(self.manager.discoverWorkshopIDs(self.scraper, SINCE))
+        self.assertEqual(ids.count("2000000202"), 1)
+        self.assertEqual(ids.count("2000009999"), 1)
+
+    def test_partial_batch_is_sent_when_ids_stall(self):
+        resolvedFirst = threading.Event()
+        def crawl():
+            yield "2000000101"
+            # The next browse page only comes in once the id from the first one has been resolved
+            self.assertTrue(resolvedFirst.wait(5))
+            yield "2000000102"
+        results = scraper.resolveWorkshopDetails(self.scraper, self.manager, crawl(), SINCE)
+        self.assertEqual(next(results)[0], "2000000101")
+        resolvedFirst.set()
+        self.assertEqual([ id for id, _ in results ], [ "2000000102" ])
+
+
+if __name__ == "__main__":
+    unittest.main()